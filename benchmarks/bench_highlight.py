@@ -0,0 +1,155 @@
+"""Times syntax highlighting of a large wrangle with VexHighlighter.
+
+Run with any python that has PySide2, no Houdini required:
+    python benchmarks/bench_highlight.py [lines] [--legacy]
+"""
+import os
+
+import sys
+
+import time
+
+import random
+
+from common import ROOT
+
+from PySide2 import QtCore, QtGui, QtWidgets
+
+from vex_snippet_library.widgets import vex_highlighter
+
+
+def wrangle(lines):
+    """A synthetic wrangle mixing every kind of token the highlighter
+    colors"""
+    rng = random.Random(0)
+    path = os.path.join(ROOT, 'resources', 'vex_syntax', 'vex_functions.txt')
+    with open(path, 'r') as f:
+        functions = f.read().split()
+    templates = [
+        'float d{i} = {f}(@P, v@N * {i});',
+        'vector p{i} = {f}(0, "P", @ptnum);  // sample {i}',
+        'if (d{i} > ch("thresh")) {{ i@group_{i} = 1; }}',
+        'foreach (int n; {f}(0, @P, 1.0, {i})) {{',
+        '}}',
+        '#include "voplib.h"',
+        "string s{i} = 'name_{i}';",
+        '/* block comment {i}',
+        '   continues here */',
+        'for (int j = 0; j < {i}; j++) f@mass += {f}(j);',
+    ]
+    return '\n'.join(
+        rng.choice(templates).format(i=i, f=rng.choice(functions))
+        for i in range(lines))
+
+
+class OverlayHighlighter(vex_highlighter.VexHighlighter):
+    """The 8-pattern overlay highlighter used before the single pass lexer,
+    with its expressions compiled once"""
+    def __init__(self, *args, **kwargs):
+        super(OverlayHighlighter, self).__init__(*args, **kwargs)
+        self.utils = vex_highlighter.VexSyntaxUtilities()
+        self.utils.load_vex_syntax()
+        self.patterns = {
+            'data_types': r'\b({})\b(?=\s|$)'.format(
+                self.utils.vex_data_types),
+            'functions': r'\b({})(?=\s|[(]|$)'.format(
+                self.utils.vex_functions),
+            'keywords': r'\b({})(?=\s|[(]|$)'.format(
+                self.utils.vex_keywords),
+            'attributes': r'((?<!\w)[A-Za-z0-9]?)\@\w+',
+            'string_double': r'"[^"\\]*(\\.[^"\\]*)*"',
+            'string_single': r"'[^'\\]*(\\.[^'\\]*)*'",
+            'macros': r'#[^\n]*',
+            'comment': r'\/\/[^\n]*'
+            }
+        self.expressions = []
+        for pattern, exp in self.patterns.items():
+            expression = QtCore.QRegularExpression(exp)
+            expression.optimize()
+            self.expressions.append((expression, self.colors[pattern]))
+        self.comment_start = QtCore.QRegExp(r'(\/\*)')
+        self.comment_end = QtCore.QRegExp(r'(\*\/)')
+
+    def highlightBlock(self, text):
+        self.setFormat(0, len(text), self.colors['default'])
+        for expression, color in self.expressions:
+            index = expression.globalMatch(text, 0)
+            while index.hasNext():
+                match = index.next()
+                self.setFormat(
+                    match.capturedStart(), match.capturedLength(), color)
+        self.setCurrentBlockState(0)
+        self.match_multiline(text, self.comment_start, self.comment_end)
+
+    def match_multiline(self, text, start_pattern, end_pattern):
+        in_state = 1
+        if self.previousBlockState() == in_state:
+            start = 0
+            add = 0
+        else:
+            start = start_pattern.indexIn(text)
+            add = start_pattern.matchedLength()
+        while start >= 0:
+            end = end_pattern.indexIn(text, start + add)
+            if end >= add:
+                length = end - start + add + end_pattern.matchedLength()
+                self.setCurrentBlockState(0)
+            else:
+                self.setCurrentBlockState(in_state)
+                length = len(text) - start + add
+            self.setFormat(start, length, self.colors['comment'])
+            start = start_pattern.indexIn(text, start + length)
+
+
+class LegacyHighlighter(OverlayHighlighter):
+    """The overlay highlighter compiling every expression per block"""
+    def highlightBlock(self, text):
+        self.setFormat(0, len(text), self.colors['default'])
+        for pattern, exp in self.patterns.items():
+            expression = QtCore.QRegularExpression(self.patterns[pattern])
+            index = expression.globalMatch(text, 0)
+            while index.hasNext():
+                match = index.next()
+                start = match.capturedStart()
+                end = match.capturedLength()
+                self.setFormat(start, end, self.colors[pattern])
+
+        self.setCurrentBlockState(0)
+        comment_start = QtCore.QRegExp(r'(\/\*)')
+        comment_end = QtCore.QRegExp(r'(\*\/)')
+        self.match_multiline(text, comment_start, comment_end)
+
+
+def time_highlight(label, highlighter_class, text, repeat=3):
+    """Best of repeat setPlainText calls on a document laid out like the
+    one in VexEditor"""
+    best = None
+    for _ in range(repeat):
+        document = QtGui.QTextDocument()
+        document.setDocumentLayout(
+            QtWidgets.QPlainTextDocumentLayout(document))
+        highlighter = highlighter_class(document)
+        start = time.perf_counter()
+        document.setPlainText(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+        highlighter.setDocument(None)
+    print('{:<40}{:>10.3f}s'.format(label, best))
+
+
+def main():
+    args = [x for x in sys.argv[1:] if not x.startswith('--')]
+    lines = int(args[0]) if args else 2000
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    text = wrangle(lines)
+    print('Highlight setPlainText, {} lines'.format(lines))
+    if '--legacy' in sys.argv:  # minutes rather than seconds
+        time_highlight('per block compile', LegacyHighlighter, text,
+                       repeat=1)
+    time_highlight('shared compiled expressions', OverlayHighlighter, text)
+    time_highlight('single pass lexer', vex_highlighter.VexHighlighter, text)
+    del app
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""Compares the memory and data() cost of SnippetModel row layouts.
+
+Run with any python that has PySide2, no Houdini required:
+    python benchmarks/bench_memory.py [count]
+"""
+import gc
+
+import sys
+
+import time
+
+import tracemalloc
+
+import common
+
+from PySide2 import QtCore
+
+from vex_snippet_library.search_index import SearchIndex, tokenize
+from vex_snippet_library.snippet import Snippet, LazySnippet, natural_key
+from vex_snippet_library.widgets import button_table
+
+
+class DictSnippet(object):
+    """Snippet as it was before __slots__, attributes in a __dict__"""
+    def __init__(self, input_dict):
+        self.label = input_dict['label']
+        self.context = input_dict['context']
+        self.data = input_dict['data']
+        self.new_name = ''
+        self.terms = None
+        self.source = None
+
+    @property
+    def label(self):
+        return self._label
+
+    @label.setter
+    def label(self, value):
+        self._label = value
+        self.sort_key = natural_key(value)
+
+
+def fetch(label):
+    return ''
+
+
+def synthetic_snippets(cls, count, lazy=False):
+    """The benchmarks' synthetic snippets as cls, every one with its own
+    context string like a json load"""
+    snippets = []
+    for snippet in common.synthetic_snippets(count):
+        context = ''.join(snippet.context)  # a copy, like json.load
+        if lazy:  # header and terms only, like a manifest load
+            snippets.append(LazySnippet(
+                snippet.label, context, fetch, snippet.label,
+                tokenize(snippet.data)))
+            continue
+        snippets.append(cls({'label': snippet.label, 'context': context,
+                             'data': snippet.data}))
+    return snippets
+
+
+def traced(func, *args):
+    """Bytes still allocated by func once it returned, and its result"""
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size, result
+
+
+def build_model(cls, count, lazy, columns):
+    model = button_table.SnippetModel()
+    if columns:
+        model.use_columns()
+    model.insert_batch(synthetic_snippets(cls, count, lazy))
+    return model
+
+
+def build_index(snippets):
+    index = SearchIndex()
+    for snippet in snippets:
+        index.add(snippet)
+    return index
+
+
+def measure(label, cls, columns, count, lazy):
+    """Traced bytes of a model loaded with count snippets, the rows are
+    what is left after taking off the size of its search index"""
+    # tokenized while traced, lazy snippets come with their terms
+    snippets = synthetic_snippets(Snippet, count)
+    index_size, index = traced(build_index, snippets)
+    del index, snippets
+    total, model = traced(build_model, cls, count, lazy, columns)
+    rows = total - index_size
+
+    start = time.perf_counter()
+    for row in range(model.rowCount()):
+        index = model.index(row, 0)
+        model.data(index, QtCore.Qt.DisplayRole)
+        model.data(index, QtCore.Qt.ToolTipRole)
+    elapsed = time.perf_counter() - start
+    print('{:<28}{:>10.1f}MB{:>10.1f}MB{:>8.0f}B{:>10.3f}s'.format(
+        label, total / 1e6, rows / 1e6, rows / count, elapsed))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print('SnippetModel layouts, {} snippets'.format(count))
+    print('{:<28}{:>12}{:>12}{:>9}{:>11}'.format(
+        '', 'total', 'rows', 'per row', 'data()'))
+    measure('objects, __dict__', DictSnippet, False, count, False)
+    measure('objects, __slots__', Snippet, False, count, False)
+    measure('columns', Snippet, True, count, False)
+    measure('objects, lazy bodies', Snippet, False, count, True)
+    measure('columns, lazy bodies', Snippet, True, count, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""Times the panel's interactive scenarios on synthetic libraries.
+
+Each scenario drives the same SnippetModel, SnippetProxyModel, VexEditor,
+loader, writer and store code the panel uses, under an offscreen Qt
+platform. The report is printed as a table and can be written as json,
+comparing it with an earlier report shows the regressions.
+
+Run with any python that has PySide2, no Houdini required:
+    python benchmarks/bench_suite.py [--sizes 1000,10000,100000]
+        [--storage directory|packed] [--columns] [--repeat 3]
+        [--json report.json] [--compare baseline.json]
+"""
+import os
+
+import json
+
+import time
+
+import shutil
+
+import argparse
+
+import platform
+
+import tempfile
+
+from common import synthetic_library, synthetic_snippets
+
+import PySide2
+from PySide2 import QtCore, QtWidgets
+
+from vex_snippet_library import loader, storage, writer
+from vex_snippet_library.widgets import button_table
+from vex_snippet_library.widgets import vex_editor
+
+EDITS = 50  # rows selected, saved and renamed per scenario
+
+
+class Bench(object):
+    """Runs the scenarios of one library and collects their results"""
+    def __init__(self, root, kind, columns, repeat):
+        self.root = root
+        self.kind = kind
+        self.columns = columns
+        self.repeat = repeat
+        self.results = []
+        self.store = None
+        self.table = None
+
+    def record(self, scenario, size, times, **extra):
+        result = {'scenario': scenario, 'size': size,
+                  'best': min(times), 'mean': sum(times) / len(times),
+                  'runs': len(times)}
+        result.update(extra)
+        self.results.append(result)
+        print('{:<24}{:>8}{:>12.4f}s{:>12.4f}s'.format(
+            scenario, size, result['best'], result['mean']))
+
+    def new_table(self):
+        table = button_table.ButtonTable()
+        if self.columns:
+            table.model.use_columns()
+        table.resize(300, 800)
+        return table
+
+    def load(self):
+        """What the panel does in the background: scan, read, batch and
+        index on the loader task, insert each batch into the model"""
+        self.store = storage.open_store(self.root, self.kind)
+        table = self.new_table()
+        signals = loader.LoaderSignals()
+        # inserted like SnippetLibrary inserts each batch
+        signals.batchLoaded.connect(
+            lambda snippets, index: table.model.insert_batch(
+                list(snippets), index))
+        loader.LoaderTask(self.store, signals).run()
+        return table
+
+    def cold_load(self, size):
+        """Load without a manifest, with an up to date one and with one
+        percent of the files changed since it was written"""
+        manifest = os.path.join(self.root, 'json_manifest.json')
+        cold, warm, touched = [], [], []
+        for run in range(self.repeat):
+            if os.path.isfile(manifest):
+                os.remove(manifest)
+            start = time.perf_counter()
+            self.load()
+            cold.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            self.table = self.load()
+            warm.append(time.perf_counter() - start)
+            if self.kind != 'directory':
+                continue
+            model = self.table.model
+            for row in range(0, size, 100):
+                snippet = model.table_data[row]
+                snippet.data = '// touched {}\n{}'.format(run, snippet.data)
+                self.store.write(snippet)
+            start = time.perf_counter()
+            self.table = self.load()
+            touched.append(time.perf_counter() - start)
+        self.record('cold_load', size, cold)
+        if self.kind == 'directory':
+            self.record('warm_load', size, warm)
+            self.record('touched_load', size, touched)
+        assert self.table.model.rowCount() == size
+
+    def insert_collisions(self, size):
+        """A batch where every other snippet is named NewSnippet"""
+        times = []
+        for _ in range(self.repeat):
+            snippets = synthetic_snippets(size, seed=1)
+            for snippet in snippets[::2]:
+                snippet.label = 'NewSnippet'
+            model = self.new_table().model
+            start = time.perf_counter()
+            model.insert_batch(snippets)
+            times.append(time.perf_counter() - start)
+        self.record('insert_collisions', size, times)
+
+    def filter_typing(self, size, query='point normal'):
+        """Type query one character at a time, then clear it"""
+        proxy = self.table.filter
+        times, worst = [], 0.0
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            for i in range(1, len(query) + 1):
+                stroke = time.perf_counter()
+                proxy.set_filter_text(query[:i])
+                worst = max(worst, time.perf_counter() - stroke)
+            proxy.set_filter_text('')
+            times.append(time.perf_counter() - start)
+        self.record('filter_typing', size, times, keystrokes=len(query),
+                    worst_keystroke=worst)
+
+    def sort(self, size):
+        proxy = self.table.filter
+        times = []
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            proxy.sort(0)
+            proxy.sort(-1)
+            times.append(time.perf_counter() - start)
+        self.record('sort', size, times)
+
+    def edit_rows(self, size):
+        step = max(1, size // EDITS)
+        return list(range(0, size, step))[:EDITS]
+
+    def select_highlight(self, size, editor):
+        """Select rows and show each snippet like update_selection"""
+        table = self.table
+        times = []
+        for _ in range(self.repeat):
+            editor.documents.clear()
+            start = time.perf_counter()
+            for row in self.edit_rows(size):
+                table.setCurrentIndex(table.filter.index(row, 0))
+                snippet = table.currentIndex().data(QtCore.Qt.UserRole)
+                editor.show_snippet(snippet.label, snippet.data)
+            times.append(time.perf_counter() - start)
+        self.record('select_highlight', size, times, rows=EDITS)
+
+    def bulk_indent(self, size, editor):
+        """Indent and unindent the largest snippet as one selection"""
+        model = self.table.model
+        largest = max(range(size), key=lambda x: len(
+            model.table_data[x].data))
+        text = model.table_data[largest].data
+        times = []
+        for _ in range(self.repeat):
+            editor.setPlainText(text)
+            document = editor.document()
+            first, last = document.firstBlock(), document.lastBlock()
+            start = time.perf_counter()
+            editor.indent_blocks(first, last)
+            editor.unindent_blocks(first, last)
+            times.append(time.perf_counter() - start)
+        self.record('bulk_indent', size, times,
+                    lines=text.count('\n'))
+
+    def save(self, size):
+        """Update rows like save_snippet and write them behind"""
+        model = self.table.model
+        snippet_writer = writer.SnippetWriter(self.store)
+        times = []
+        for run in range(self.repeat):
+            start = time.perf_counter()
+            for row in self.edit_rows(size):
+                index = model.index(row, 0)
+                snippet = model.data(index, QtCore.Qt.UserRole)
+                snippet.data = '// saved {}\n{}'.format(run, snippet.data)
+                model.setData(index, snippet, QtCore.Qt.UserRole)
+                snippet_writer.write(snippet)
+            queued = time.perf_counter() - start
+            snippet_writer.flush()
+            times.append(time.perf_counter() - start)
+        self.record('save', size, times, rows=EDITS, queued=queued)
+
+    def rename(self, size):
+        """Rename rows in the model and the store, and back"""
+        model = self.table.model
+        times = []
+        for _ in range(self.repeat):
+            labels = [model.label(x) for x in self.edit_rows(size)]
+            start = time.perf_counter()
+            for label in labels:
+                new_label = model.build_unique_label('renamed_' + label)
+                for old, new in ((label, new_label), (new_label, label)):
+                    row = model.find_row(old)
+                    source = self.store.rename(model.table_data[row], new)
+                    model.rename(row, new, source)
+            times.append(time.perf_counter() - start)
+        self.record('rename', size, times, rows=EDITS * 2)
+
+    def run(self, size):
+        editor = vex_editor.VexEditor()
+        editor.resize(600, 800)
+        self.cold_load(size)
+        self.insert_collisions(size)
+        self.filter_typing(size)
+        self.sort(size)
+        self.select_highlight(size, editor)
+        self.bulk_indent(size, editor)
+        self.save(size)
+        self.rename(size)
+
+
+def compare(results, path):
+    """Print each scenario's best time against an earlier report"""
+    with open(path, 'r') as f:
+        baseline = dict(((x['scenario'], x['size']), x['best'])
+                        for x in json.load(f)['results'])
+    print('\nAgainst {}'.format(path))
+    for result in results:
+        before = baseline.get((result['scenario'], result['size']))
+        if before:
+            print('{:<24}{:>8}{:>12.2f}x'.format(
+                result['scenario'], result['size'], result['best'] / before))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000')
+    parser.add_argument('--storage', default='directory',
+                        choices=['directory', 'packed'])
+    parser.add_argument('--columns', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    report = {
+        'python': platform.python_version(),
+        'pyside2': PySide2.__version__,
+        'qt': QtCore.qVersion(),
+        'platform': platform.platform(),
+        'storage': args.storage,
+        'model_layout': 'columns' if args.columns else 'objects',
+        'results': [],
+    }
+    print('{:<24}{:>8}{:>13}{:>13}'.format('', 'size', 'best', 'mean'))
+    for size in [int(x) for x in args.sizes.split(',')]:
+        root = tempfile.mkdtemp()
+        try:
+            synthetic_library(root, size, args.storage)
+            bench = Bench(root, args.storage, args.columns, args.repeat)
+            bench.run(size)
+            report['results'].extend(bench.results)
+        finally:
+            shutil.rmtree(root)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4)
+    if args.compare:
+        compare(report['results'], args.compare)
+    del app
+
+
+if __name__ == '__main__':
+    main()
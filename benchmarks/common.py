@@ -0,0 +1,72 @@
+"""Path setup and synthetic libraries shared by the benchmarks.
+
+Importing it puts python3.7libs on sys.path and selects the offscreen Qt
+platform, so the benchmarks run with any python that has PySide2.
+"""
+import os
+
+import sys
+
+import json
+
+import random
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'python3.7libs'))
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from vex_snippet_library import storage  # noqa: E402
+from vex_snippet_library.snippet import Snippet  # noqa: E402
+
+CONTEXTS = ['Detail', 'Points', 'Primitives', 'Vertices']
+WORDS = ['scatter', 'noise', 'curl', 'pcfind', 'group', 'attrib', 'ramp',
+         'point', 'normal', 'velocity', 'age', 'color']
+LINES = [1, 3, 8, 20, 60, 250, 1000]  # body sizes, in lines
+LINE_WEIGHTS = [20, 30, 25, 15, 6, 3, 1]
+TEMPLATES = [
+    'vector p{i} = point(0, "P", @ptnum + {i});',
+    'float d{i} = length(@P - p{i}) * ch("scale");  // falloff {i}',
+    'if (d{i} > 0.5) {{ i@group_{w} = 1; }}',
+    'foreach (int n; nearpoints(0, @P, 1.0, {i})) {{',
+    '}}',
+    'f@{w} += fit01(rand(@ptnum + {i}), 0, 1);',
+    'v@N = normalize(v@N + curlnoise(@P * {i}));',
+]
+
+
+def body(rng, lines):
+    return ''.join(
+        rng.choice(TEMPLATES).format(i=i, w=rng.choice(WORDS)) + '\n'
+        for i in range(lines))
+
+
+def synthetic_snippets(count, seed=0):
+    """Snippets of varied body sizes, a quarter of them named NewSnippet
+    and numbered the way the panel numbers colliding names"""
+    rng = random.Random(seed)
+    snippets = []
+    for i in range(count):
+        if i % 4 == 0:
+            label = 'NewSnippet{}'.format(i // 4 or '')
+        else:
+            label = '{}_{}_{}'.format(
+                rng.choice(WORDS), rng.choice(WORDS), i)
+        lines = rng.choices(LINES, LINE_WEIGHTS)[0]
+        snippets.append(Snippet({'label': label,
+                                 'context': CONTEXTS[i % 4],
+                                 'data': body(rng, lines)}))
+    return snippets
+
+
+def synthetic_library(root, count, kind='directory'):
+    """Write a library to root, directory files without the store's
+    fsync"""
+    snippets = synthetic_snippets(count)
+    if kind == 'packed':
+        storage.PackedStore(os.path.join(root, 'snippets.db')).write_many(
+            snippets)
+        return
+    store = storage.DirectoryStore(os.path.join(root, 'json'))
+    for snippet in snippets:
+        with open(store.path(snippet.label), 'w') as f:
+            json.dump(snippet.to_dict(), f, indent=4)
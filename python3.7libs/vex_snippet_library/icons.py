@@ -0,0 +1,53 @@
+"""Process-wide cache of the panel icons.
+
+Icons are decoded once per session and shared by every widget, so views
+can repaint and scroll without touching the disk.
+"""
+import os
+
+from PySide2 import QtCore, QtGui
+
+from .profiler import profiler
+
+ICON_DIR = os.path.abspath(
+    os.path.join(__file__, '..', '..', '..', 'resources', 'icons'))
+
+CONTEXT_ICONS = {
+    'Detail': 'info.svg',
+    'Points': 'filter_color_blue.svg',
+    'Primitives': 'display_primitive_normals.svg',
+    'Vertices': 'filter_color_purple.svg'
+}
+
+_icons = {}
+_pixmaps = {}
+
+
+def icon(name):
+    """Return the shared QIcon for an icon file in resources/icons"""
+    cached = _icons.get(name)
+    if cached is None:
+        with profiler.span('icon', file=name):
+            cached = QtGui.QIcon(os.path.join(ICON_DIR, name))
+        _icons[name] = cached
+    return cached
+
+
+def context_icon(context):
+    name = CONTEXT_ICONS.get(context)
+    if name is None:
+        return None
+    return icon(name)
+
+
+def pixmap(name, width, height=None):
+    """Return the icon rasterized at the given size for the current DPI"""
+    height = height or width
+    app = QtGui.QGuiApplication.instance()
+    ratio = app.devicePixelRatio() if app else 1.0
+    key = (name, width, height, ratio)
+    cached = _pixmaps.get(key)
+    if cached is None:
+        cached = icon(name).pixmap(QtCore.QSize(width, height))
+        _pixmaps[key] = cached
+    return cached
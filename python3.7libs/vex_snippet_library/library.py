@@ -0,0 +1,241 @@
+"""The snippet library shared by every panel of a session.
+
+The first panel opened for a package root creates its library: the
+store, model, loader, writer and watcher. Panels opened after it are
+views over the same model, so they open without reading the library
+again, and each change is applied once and then announced to every
+panel.
+"""
+import logging
+
+from PySide2 import QtCore, QtWidgets
+
+from . import loader
+
+from . import storage
+
+from . import writer
+
+from . import watcher
+
+from .snippet import bodies, clean_label
+
+from .profiler import profiler
+
+from .widgets import button_table
+
+logger = logging.getLogger('vex_snippet_library.main_panel.library')
+
+_libraries = {}  # package root -> SnippetLibrary
+
+
+class SnippetLibrary(QtCore.QObject):
+    """Store, model and background services of one package root.
+
+    changed is emitted with the labels whose snippets were changed,
+    renamed away or removed, panels drop what they cached for them.
+    Changes made by other sessions are held back while any panel edits
+    a snippet.
+    """
+    batchLoaded = QtCore.Signal()
+    progress = QtCore.Signal(int, int)
+    changed = QtCore.Signal(object)
+
+    def __init__(self, root, options, parent=None):
+        super(SnippetLibrary, self).__init__(parent)
+        self.root = root
+        self.options = options
+        bodies.budget = int(options['body_cache_mb'] * 1024 * 1024)
+        self.store = storage.open_store(root, options['storage'])
+        self.model = button_table.SnippetModel()
+        if options['model_layout'] == 'columns':
+            self.model.use_columns()
+        self.model.dataChanged.connect(self._label_renamed)
+        self.writer = writer.SnippetWriter(self.store, self)
+        self.writer.failed.connect(self.write_failed)
+        self.watcher = watcher.LibraryWatcher(self.store, self)
+        self.watcher.changed.connect(self.apply_changes)
+        self.loader = None
+        self._loaded = False
+        self._panels = set()
+        self._editing = set()  # panels holding back changes
+        app = QtWidgets.QApplication.instance()
+        if app:
+            app.aboutToQuit.connect(self.shutdown)
+
+    def attach(self, panel):
+        """Register a panel, the first one loads the library"""
+        self._panels.add(panel)
+        if self.loader is None and not self._loaded:
+            self.load()
+        elif self._loaded and len(self._panels) == 1:
+            self.start_watching()  # picks up what changed while closed
+
+    def detach(self, panel):
+        """Unregister a panel on close or destruction, the last one stops
+        watching and flushes the writes"""
+        if panel not in self._panels:
+            return
+        self._panels.discard(panel)
+        self.resume(panel)
+        if not self._panels:
+            self.watcher.stop()
+            self.writer.flush()
+
+    def load(self):
+        if self.options['background_load']:
+            self.loader = loader.SnippetLoader(self.store, self)
+            self.loader.batchLoaded.connect(self._batch_loaded)
+            self.loader.progress.connect(self.progress)
+            self.loader.finished.connect(self._load_finished)
+            self.loader.start()
+            return
+
+        snippets = []
+        with profiler.span('load'):
+            with profiler.span('scan'):
+                entries = self.store.scan()
+            for entry in entries:
+                try:
+                    snippets.append(self.store.read(entry))
+                except (OSError, ValueError, KeyError) as e:
+                    logger.warning(
+                        'Could not read snippet {}: {}'.format(entry, e))
+            self.model.insert_batch(snippets)
+        profiler.count('snippets_loaded', len(snippets))
+        try:
+            self.store.write_manifest()
+        except OSError as e:
+            logger.warning('Could not write the manifest: {}'.format(e))
+        self.batchLoaded.emit()
+        self._load_finished()
+
+    def _batch_loaded(self, snippets, index):
+        self.model.insert_batch(list(snippets), index)
+        self.batchLoaded.emit()
+
+    def _load_finished(self):
+        self.loader = None
+        self._loaded = True
+        if self._panels:
+            self.start_watching()
+
+    def start_watching(self):
+        if self.options['watch_library']:
+            self.watcher.start(self.options['watch_interval'])
+
+    def pause(self, panel):
+        """Hold back changes from other sessions while panel edits"""
+        self._editing.add(panel)
+        self.watcher.pause()
+
+    def resume(self, panel):
+        if panel not in self._editing:
+            return
+        self._editing.discard(panel)
+        if not self._editing:
+            self.watcher.resume()
+
+    def apply_changes(self, changes):
+        """Apply snippets added, changed, renamed or removed by other
+        sessions row by row.
+
+        Rows are matched by the source they were read from, their labels
+        may have been made unique on load. A row takes the label stored
+        with its snippet unless another row holds it.
+        """
+        model = self.model
+        stale = set()
+        for source in changes.removed:
+            label = model.source_label(source)
+            if label is not None:
+                model.remove_label(label)
+                stale.add(label)
+
+        added = []
+        changed = list(changes.renamed)
+        changed.extend((x.source, x) for x in changes.snippets)
+        for old_source, snippet in changed:
+            label = model.source_label(old_source)
+            if label is None:
+                added.append(snippet)
+                continue
+            new_label = clean_label(snippet.label)
+            if new_label != label and model.find_row(new_label) != -1:
+                new_label = label
+            if new_label != label or old_source != snippet.source:
+                model.rename(model.find_row(label), new_label, snippet.source)
+                stale.add(label)
+            snippet.label = new_label
+            if model.update_item(snippet):
+                stale.add(new_label)
+        model.insert_batch(added)
+        self.changed.emit(stale)
+
+    def write(self, snippet):
+        logger.debug('Writing snippet: {}'.format(snippet.to_dict()))
+        if snippet.source is None:  # new, stored under its label
+            snippet.source = self.store.source(
+                snippet.label, self.model.sources())
+        self.writer.write(snippet)
+        self.watcher.invalidate()
+
+    def update(self, index, snippet):
+        """Save an edited snippet over its row"""
+        self.model.setData(index, snippet, QtCore.Qt.UserRole)
+        self.write(snippet)
+        self.changed.emit({snippet.label})
+
+    def delete(self, label):
+        row = self.model.find_row(label)
+        if row == -1:
+            return False
+        self.writer.flush()  # a queued write would bring it back
+        if not self.store.delete(self.model.table_data[row]):
+            return False
+        self.watcher.invalidate()
+        self.model.remove_label(label)
+        self.changed.emit({label})
+        return True
+
+    def _label_renamed(self, top_left, bottom_right, roles):
+        if QtCore.Qt.EditRole not in roles:
+            return
+        snippet = top_left.data(role=QtCore.Qt.UserRole)
+        old_label = snippet.label
+        logger.debug('Rename: (From: {}, To: {})'.format(
+            old_label, snippet.new_name))
+
+        self.writer.flush()
+        source = self.store.rename(snippet, snippet.new_name)
+        self.model.rename(top_left.row(), snippet.new_name, source)
+        self.write(snippet)
+        self.changed.emit({old_label})
+
+    def write_failed(self, labels, error):
+        logger.error('Snippets not saved: {} ({})'.format(
+            ', '.join(labels), error))
+
+    def shutdown(self):
+        if self.loader is not None:
+            self.loader.cancel()
+        self.watcher.stop()
+        self.writer.flush()
+        profiler.dump()
+
+
+def shared_library(root, options):
+    """Return the session's library of a package root, options only
+    apply when it is created"""
+    library = _libraries.get(root)
+    if library is None:
+        library = _libraries[root] = SnippetLibrary(root, options)
+    return library
+
+
+def close_libraries():
+    """Cancel loading, flush and forget every library, e.g. before the
+    package is reloaded"""
+    for library in _libraries.values():
+        library.shutdown()
+    _libraries.clear()
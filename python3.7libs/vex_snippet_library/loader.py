@@ -0,0 +1,107 @@
+import logging
+
+from PySide2 import QtCore
+
+from .search_index import SearchIndex
+
+from .tasks import TaskSignals
+
+from .profiler import profiler
+
+logger = logging.getLogger('vex_snippet_library.main_panel.loader')
+
+
+class LoaderSignals(TaskSignals):
+    batchLoaded = QtCore.Signal(object, object)
+    progress = QtCore.Signal(int, int)
+    finished = QtCore.Signal()
+
+
+class LoaderTask(QtCore.QRunnable):
+    """Reads snippets from a store on a pool thread and emits them in batches.
+
+    The first batch is kept small so the first screenful of the table can
+    be shown before the rest of the library has been read. Stores scan in
+    label order, so each batch lands below the rows already loaded. Each
+    batch comes with a SearchIndex of its snippets, so tokenizing bodies
+    stays off the GUI thread as well.
+    """
+    first_batch_size = 64
+    batch_size = 512
+
+    def __init__(self, store, signals):
+        super(LoaderTask, self).__init__()
+        self.store = store
+        self.signals = signals
+        self.cancelled = False
+
+    def run(self):
+        with profiler.span('load'):
+            self.load()
+
+    def load(self):
+        with profiler.span('scan'):
+            entries = self.store.scan()
+        total = len(entries)
+        self.signals.send('progress', 0, total)
+
+        batch = []
+        index = SearchIndex()
+        size = self.first_batch_size
+        for i, entry in enumerate(entries):
+            if self.cancelled:
+                return
+            try:
+                snippet = self.store.read(entry)
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(
+                    'Could not read snippet {}: {}'.format(entry, e))
+            else:
+                profiler.count('snippets_loaded')
+                batch.append(snippet)
+                if snippet.label not in index:
+                    index.add(snippet)
+            if len(batch) >= size:
+                self.signals.send('batchLoaded', batch, index)
+                self.signals.send('progress', i + 1, total)
+                batch = []
+                index = SearchIndex()
+                size = self.batch_size
+
+        if self.cancelled:
+            return
+        if batch:
+            self.signals.send('batchLoaded', batch, index)
+        try:
+            self.store.write_manifest()
+        except OSError as e:
+            logger.warning('Could not write the manifest: {}'.format(e))
+        self.signals.send('progress', total, total)
+        self.signals.send('finished')
+
+
+class SnippetLoader(QtCore.QObject):
+    """Loads a snippet library in the background.
+
+    Batches of parsed Snippet objects are delivered on the GUI thread
+    through the batchLoaded signal, progress is reported as (done, total).
+    """
+    batchLoaded = QtCore.Signal(object, object)
+    progress = QtCore.Signal(int, int)
+    finished = QtCore.Signal()
+
+    def __init__(self, store, parent=None):
+        super(SnippetLoader, self).__init__(parent)
+        self.store = store
+        self._task = None
+        self._signals = LoaderSignals()
+        self._signals.forward(self, 'batchLoaded', 'progress', 'finished')
+
+    def start(self):
+        self._task = LoaderTask(self.store, self._signals)
+        self._task.setAutoDelete(False)
+        QtCore.QThreadPool.globalInstance().start(self._task)
+
+    def cancel(self):
+        if self._task:
+            self._task.cancelled = True
@@ -1,24 +1,41 @@
 import os
 
-import json
-
 import logging
 
 import sys
 
 import configparser
 
+import time
+
 from PySide2 import QtWidgets, QtCore, QtGui
 
 from .widgets import snippet_editor
 
 from .widgets import snippet_viewer
 
-from .widgets import button_table
+from . import library
+
+from .snippet import Snippet
+
+from .profiler import profiler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+ROOT = os.path.abspath(
+    os.path.join(os.path.abspath(__file__), '..', '..', '..'))
+DEV_RELOAD_VAR = 'VEX_SNIPPET_LIBRARY_DEV_RELOAD'
+
+
+def dev_reload():
+    """Whether each new panel re-imports the package, for working on its
+    source. Set by the environment variable, else by options.ini"""
+    value = os.environ.get(DEV_RELOAD_VAR)
+    if value is not None:
+        return value.strip().lower() in ('1', 'true', 'on', 'yes')
+    return Options(ROOT).read()['dev_reload']
+
 
 class Options(object):
     def __init__(self, root_dir):
@@ -38,6 +55,17 @@ class Options(object):
 
         config.set(
             'GENERAL', 'editor_font_size', '{}'.format(editor_font_default))
+        config.set('GENERAL', 'background_load', 'true')
+        config.set('GENERAL', 'storage', 'directory')
+        config.set('GENERAL', 'deferred_highlight_lines', '1000')
+        config.set('GENERAL', 'document_cache_mb', '32')
+        config.set('GENERAL', 'body_cache_mb', '16')
+        config.set('GENERAL', 'model_layout', 'objects')
+        config.set('GENERAL', 'watch_library', 'true')
+        config.set('GENERAL', 'watch_interval', '10')
+        config.set('GENERAL', 'profile', 'off')
+        config.set('GENERAL', 'profile_path', '')
+        config.set('GENERAL', 'dev_reload', 'false')
 
         with open(self.config, 'w+') as f:
             config.write(f)
@@ -46,28 +74,41 @@ class Options(object):
         config = configparser.ConfigParser()
         config.read(self.config)
         return {
-            'editor_font_size': config.getfloat('GENERAL', 'editor_font_size')
+            'editor_font_size': config.getfloat('GENERAL', 'editor_font_size'),
+            'background_load': config.getboolean(
+                'GENERAL', 'background_load', fallback=True),
+            'storage': config.get('GENERAL', 'storage', fallback='directory'),
+            'deferred_highlight_lines': config.getint(
+                'GENERAL', 'deferred_highlight_lines', fallback=1000),
+            'document_cache_mb': config.getfloat(
+                'GENERAL', 'document_cache_mb', fallback=32),
+            'body_cache_mb': config.getfloat(
+                'GENERAL', 'body_cache_mb', fallback=16),
+            'model_layout': config.get(
+                'GENERAL', 'model_layout', fallback='objects'),
+            'watch_library': config.getboolean(
+                'GENERAL', 'watch_library', fallback=True),
+            'watch_interval': config.getfloat(
+                'GENERAL', 'watch_interval', fallback=10),
+            'profile': config.get('GENERAL', 'profile', fallback='off'),
+            'profile_path': config.get(
+                'GENERAL', 'profile_path', fallback=''),
+            'dev_reload': config.getboolean(
+                'GENERAL', 'dev_reload', fallback=False)
         }
 
 
-class Snippet(object):
-    def __init__(self, input_dict):
-        self.label = input_dict['label']
-        self.context = input_dict['context']
-        self.data = input_dict['data']
-        self.new_name = ''
-
-    def to_dict(self):
-        return {
-            'label': self.label,
-            'context': self.context,
-            'data': self.data
-        }
+def detach_panel(library, panel):
+    """Leave the library, the last panel stops watching and flushes its
+    writes"""
+    library.detach(panel)
+    profiler.dump()
 
 
 class VexSnippetLibrary(QtWidgets.QWidget):
     def __init__(self):
         super(VexSnippetLibrary, self).__init__()
+        start = time.perf_counter()
         self._creating = False
         self._editing = False
         self.snippet = None
@@ -75,23 +116,41 @@ class VexSnippetLibrary(QtWidgets.QWidget):
         self.cached_index = None
         self.cached_label = ''
         self.new_label = ''
-        self.root = os.path.abspath(
-            os.path.join(os.path.abspath(__file__), '..', '..', '..'))
+        self.root = ROOT
         self.json_path = os.path.join(self.root, 'json')
-        self.options = Options(self.root).read()
-        self._init_ui()
+        with profiler.span('options'):
+            self.options = Options(self.root).read()
+        self.init_profiler()
+        # every panel of the session views the same library
+        self.library = library.shared_library(self.root, self.options)
+        self.model = self.library.model
+        with profiler.span('ui'):
+            self._init_ui()
+        profiler.record('panel', start, time.perf_counter())
+
+    def init_profiler(self):
+        """Enable the profiler from options.ini, unless the environment
+        variable already did"""
+        path = self.options['profile_path'] or os.path.join(
+            self.root, 'profile.json')
+        if profiler.enabled:
+            profiler.path = profiler.path or path
+        else:
+            profiler.configure(self.options['profile'], path)
 
     def _init_ui(self):
         logger.debug('initializing panel..')
         self.layout = QtWidgets.QHBoxLayout(self)
 
-        self.snippet_viewer = snippet_viewer.SnippetViewer(self)
+        self.snippet_viewer = snippet_viewer.SnippetViewer(self, self.model)
         self.snippet_editor = snippet_editor.SnippetEditor(self)
         self.vex_editor = self.snippet_editor.editor
         self.vex_editor.setFont(
             QtGui.QFont('Source Code Pro', self.options['editor_font_size']))
+        self.vex_editor.defer_lines = self.options['deferred_highlight_lines']
+        self.vex_editor.documents.budget = int(
+            self.options['document_cache_mb'] * 1024 * 1024)
         self.table = self.snippet_viewer.table
-        self.model = self.table.model
 
         self.splitter = QtWidgets.QSplitter(QtCore.Qt.Horizontal)
         self.splitter.addWidget(self.snippet_viewer)
@@ -104,35 +163,58 @@ class VexSnippetLibrary(QtWidgets.QWidget):
         self.snippet_editor.edit_btn.clicked.connect(self.edit_snippet)
         self.snippet_editor.save_btn.clicked.connect(self.save_snippet)
         self.snippet_editor.cancel_btn.clicked.connect(self.discard_snippet)
-        self.model.dataChanged.connect(self.label_renamed)
+        self.library.changed.connect(self.library_changed)
+        self.library.batchLoaded.connect(self.snippets_loaded)
+        self.library.progress.connect(self.snippet_viewer.set_progress)
         self.table.selectionModel().selectionChanged.connect(
             self.update_selection)
 
         self.layout.addWidget(self.splitter)
 
         self.snippet_editor.edit_btn.blockSignals(True)
-        if not os.path.isdir(self.json_path):
-            os.makedirs(self.json_path)
-
         self.load_snippets()
 
+    def load_snippets(self):
+        """Attach to the library, the first panel of a session loads it"""
+        self.library.attach(self)
+        # Houdini destroys panes without sending them a close event, and
+        # slots of a destroyed panel are not called
+        library = self.library
+        self.destroyed.connect(lambda: detach_panel(library, self))
+        self.snippets_loaded()
+
+    def library_changed(self, stale):
+        """Drop what this panel cached for the stale labels and follow the
+        selected snippet, after the library changed from any panel or
+        session"""
+        for label in stale:
+            self.vex_editor.documents.discard(label)
+        if self.cached_index is None or self._editing or self._creating:
+            return  # the editor is not showing the library
+        row = self.model.find_row(self.snippet.label)
+        if row == -1:  # the selected snippet was removed
+            self.update_selection()
+            return
+        index = self.table.filter.mapFromSource(self.model.index(row, 0))
+        if (index != self.table.currentIndex() or
+                not self.table.selectionModel().hasSelection()):
+            # renamed, the view selected a neighbour of the moved row
+            self.table.setCurrentIndex(index)
+        if self.snippet.label in stale:
+            self.vex_editor.show_snippet(self.snippet.label, self.snippet.data)
+            self.snippet_editor.combo.setCurrentIndex(
+                self.snippet_editor.combo.findText(self.snippet.context))
+
+    def snippets_loaded(self):
+        if self.snippet is None:
+            self.select_first()
+
+    def select_first(self):
         # initial selection
         idx = self.table.filter.index(0, 0)
         self.snippet = idx.data(role=QtCore.Qt.UserRole)
         self.table.setCurrentIndex(idx)
 
-    def load_snippets(self):
-        snippets = []
-        for (dirpath, dirnames, filenames) in os.walk(self.json_path):
-            for file in filenames:
-                head, tail = os.path.splitext(file)
-                if tail == '.json':
-                    snippets.append(os.path.join(dirpath, file))
-        for file in snippets:
-            with open(file, 'r') as f:
-                item_dict = json.load(f)
-                self.table.add_item(Snippet(item_dict))
-
     def begin_new_snippet(self):
         self.table.blockSignals(True)
         new_label, ok = QtWidgets.QInputDialog().getText(
@@ -153,21 +235,26 @@ class VexSnippetLibrary(QtWidgets.QWidget):
 
     def save_snippet(self):
         new_snippet = self.build_new_snippet()
-        self.write_snippet(new_snippet)
         self.snippet_viewer.setEnabled(True)
+        self.library.resume(self)
 
         if self._editing:
-            filter_idx = self.table.currentIndex()
-            model_idx = self.table.filter.mapToSource(filter_idx)
-            snippet = self.model.data(model_idx, QtCore.Qt.UserRole)
-            snippet.context = self.snippet_editor.combo.currentText()
-            snippet.data = self.vex_editor.toPlainText().strip() + '\n'
-            self.model.setData(model_idx, snippet, QtCore.Qt.UserRole)
-            self.vex_editor.setPlainText(snippet.data)
+            row = self.model.find_row(new_snippet.label)
+            if row == -1:  # deleted from another panel meanwhile
+                self._creating = True
+            else:
+                model_idx = self.model.index(row, 0)
+                snippet = self.model.data(model_idx, QtCore.Qt.UserRole)
+                snippet.context = self.snippet_editor.combo.currentText()
+                snippet.data = self.vex_editor.toPlainText().strip() + '\n'
+                self.library.update(model_idx, snippet)
+                self.vex_editor.documents.discard(snippet.label)
+                self.vex_editor.show_snippet(snippet.label, snippet.data)
         if self._creating:
+            self.library.write(new_snippet)
             self.table.add_item(new_snippet)
-            rows = self.model.rowCount()
-            model_idx = self.model.index(rows - 1, 0)
+            row = self.model.find_row(new_snippet.label)
+            model_idx = self.model.index(row, 0)
             filter_idx = self.table.filter.mapFromSource(model_idx)
             if not self.snippet:
                 self.snippet = self.model.data(model_idx, QtCore.Qt.UserRole)
@@ -181,17 +268,20 @@ class VexSnippetLibrary(QtWidgets.QWidget):
             if self.table.selectionModel().hasSelection():
                 self._editing = True
                 self.snippet_viewer.setEnabled(False)
+                self.library.pause(self)
                 self.update_selection()
         else:
             self.snippet_viewer.setEnabled(False)
+            self.library.pause(self)
 
     def discard_snippet(self):
         self.vex_editor.setPlainText('')
         if self._creating:
             self.table.blockSignals(False)
         self.snippet_viewer.setEnabled(True)
+        self.library.resume(self)
         if self.cached_index:
-            self.vex_editor.setPlainText(self.snippet.data)
+            self.vex_editor.show_snippet(self.snippet.label, self.snippet.data)
         self._creating = False
         self._editing = False
 
@@ -208,12 +298,9 @@ class VexSnippetLibrary(QtWidgets.QWidget):
         }
         return Snippet(new_dict)
 
-    def write_snippet(self, snippet):
-        logger.debug('Writing snippet: {}'.format(snippet.to_dict()))
-        new_json = os.path.join(
-            self.json_path, '{}.json'.format(snippet.label))
-        with open(new_json, 'w+') as f:
-            json.dump(snippet.to_dict(), f, indent=4)
+    def closeEvent(self, event):
+        detach_panel(self.library, self)
+        super(VexSnippetLibrary, self).closeEvent(event)
 
     def delete_snippet(self):
         sel = self.table.selectionModel().selectedIndexes()
@@ -221,15 +308,14 @@ class VexSnippetLibrary(QtWidgets.QWidget):
             filter_idx = sel[0]
             model_idx = self.table.filter.mapToSource(filter_idx)
             data = self.model.data(model_idx, QtCore.Qt.DisplayRole)
-            to_del = os.path.join(self.json_path, '{}.json'.format(data))
-            if os.path.isfile(to_del):
-                os.remove(to_del)
-                self.table.remove_item()
+            if self.library.delete(data):
                 logger.debug('removed item')
                 self.table.selectionModel().clear()
                 self.update_selection()
 
     def update_selection(self):
+        if self.model.moving:
+            return  # followed once the library announces the rename
         sel = self.table.selectionModel().selectedIndexes()
         logger.debug(sel)
         if sel:
@@ -237,7 +323,7 @@ class VexSnippetLibrary(QtWidgets.QWidget):
             self.cached_index = sel[0]
             self.cached_label = self.snippet.label
             self.snippet = self.cached_index.data(role=QtCore.Qt.UserRole)
-            self.vex_editor.setPlainText(self.snippet.data)
+            self.vex_editor.show_snippet(self.snippet.label, self.snippet.data)
             combo_index = self.snippet_editor.combo.findText(
                 self.snippet.context)
             self.snippet_editor.combo.setCurrentIndex(combo_index)
@@ -250,27 +336,6 @@ class VexSnippetLibrary(QtWidgets.QWidget):
             self.vex_editor.setPlainText('')
         self.snippet_viewer.add_btn.setFocus()  # table select hotfix
 
-    def label_renamed(self, top_left, bottom_right, roles):
-        if QtCore.Qt.EditRole not in roles:
-            return
-        logger.debug('Rename: (From: {}, To: {})'.format(
-            self.snippet.label, self.snippet.new_name))
-
-        snippet = top_left.data(role=QtCore.Qt.UserRole)
-        src = os.path.join(self.json_path, '{}.json'.format(snippet.label))
-        dst = os.path.join(self.json_path, '{}.json'.format(snippet.new_name))
-        os.rename(src, dst)
-
-        self.model.beginResetModel()
-        self.table.blockSignals(True)
-        snippet.label = snippet.new_name
-        self.model.endResetModel()
-        self.table.blockSignals(False)
-
-        self.write_snippet(snippet)
-        filter_idx = self.table.filter.mapFromSource(top_left)
-        self.table.setCurrentIndex(filter_idx)
-
 
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
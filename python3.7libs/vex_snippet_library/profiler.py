@@ -0,0 +1,180 @@
+"""Process-wide timing spans and counters of the panel's hot paths.
+
+Profiling is off by default. It is turned on by profile = json or
+profile = chrome in options.ini, or by the VEX_SNIPPET_LIBRARY_PROFILE
+environment variable, which also covers the imports and options.ini
+read before the panel knows its options. Spans are recorded from any
+thread and dumped either as a summary per span name or as a Chrome
+trace that chrome://tracing and Perfetto can open.
+"""
+import os
+
+import json
+
+import time
+
+import logging
+
+import threading
+
+logger = logging.getLogger('vex_snippet_library.main_panel.profiler')
+
+ENV_VAR = 'VEX_SNIPPET_LIBRARY_PROFILE'
+FORMATS = ('json', 'chrome')
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+class Span(object):
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(
+            self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class Profiler(object):
+    """Collects spans and counters while enabled.
+
+    span returns a shared no-op context manager while disabled, so the
+    instrumented paths cost one attribute check. At most max_events spans
+    are kept, later ones only add to the summary.
+    """
+    max_events = 200000
+
+    def __init__(self):
+        self.enabled = False
+        self.format = 'json'
+        self.path = None
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._events = []  # (name, start, end, thread id, args)
+        self._totals = {}  # name -> [count, total, min, max]
+        self._counters = {}
+
+    def configure(self, setting, path=None):
+        """Enable for a format name, disable for anything else, e.g. off"""
+        setting = (setting or '').strip().lower()
+        if setting in ('1', 'true', 'on'):
+            setting = 'json'
+        if setting not in FORMATS:
+            self.enabled = False
+            return
+        self.format = setting
+        if path:
+            self.path = path
+        self.enabled = True
+
+    def span(self, name, **args):
+        if not self.enabled:
+            return _null_span
+        return Span(self, name, args)
+
+    def record(self, name, start, end, args=None):
+        """Record a span timed with time.perf_counter"""
+        if not self.enabled:
+            return
+        elapsed = end - start
+        with self._lock:
+            if len(self._events) < self.max_events:
+                self._events.append(
+                    (name, start, end, threading.get_ident(), args))
+            totals = self._totals.get(name)
+            if totals is None:
+                self._totals[name] = [1, elapsed, elapsed, elapsed]
+            else:
+                totals[0] += 1
+                totals[1] += elapsed
+                totals[2] = min(totals[2], elapsed)
+                totals[3] = max(totals[3], elapsed)
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def clear(self):
+        with self._lock:
+            self._origin = time.perf_counter()
+            self._events = []
+            self._totals = {}
+            self._counters = {}
+
+    def summary(self):
+        """Return {'spans': {name: timings in ms}, 'counters': {...}}"""
+        with self._lock:
+            spans = {}
+            for name, (count, total, low, high) in self._totals.items():
+                spans[name] = {
+                    'count': count,
+                    'total_ms': total * 1000.0,
+                    'mean_ms': total * 1000.0 / count,
+                    'min_ms': low * 1000.0,
+                    'max_ms': high * 1000.0}
+            return {'spans': spans, 'counters': dict(self._counters)}
+
+    def chrome_trace(self):
+        """Return the spans as Chrome trace complete events, the counters
+        as one counter event at the end"""
+        pid = os.getpid()
+        with self._lock:
+            origin = self._origin
+            events = []
+            last = 0.0
+            for name, start, end, tid, args in self._events:
+                ts = (start - origin) * 1e6
+                event = {'name': name, 'ph': 'X', 'ts': ts,
+                         'dur': (end - start) * 1e6, 'pid': pid, 'tid': tid}
+                if args:
+                    event['args'] = args
+                events.append(event)
+                last = max(last, ts + event['dur'])
+            if self._counters:
+                events.append({'name': 'counters', 'ph': 'C', 'ts': last,
+                               'pid': pid, 'args': dict(self._counters)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, path=None):
+        """Write the profile in the configured format, return its path"""
+        if not self.enabled:
+            return None
+        path = path or self.path
+        if path is None:
+            path = os.path.abspath('vex_snippet_library_profile.json')
+        if self.format == 'chrome':
+            profile = self.chrome_trace()
+        else:
+            profile = self.summary()
+        try:
+            with open(path, 'w') as f:
+                json.dump(profile, f, indent=1, default=str)
+        except OSError as e:
+            logger.warning('Could not write the profile: {}'.format(e))
+            return None
+        logger.info('Wrote profile to {}'.format(path))
+        return path
+
+
+profiler = Profiler()
+profiler.configure(os.environ.get(ENV_VAR))
@@ -0,0 +1,220 @@
+"""Inverted index for searching snippets by label, context and body.
+
+Labels are indexed by trigram so any substring of a label can be found
+without scanning every label. Contexts and snippet bodies are indexed by
+token. A query term matches a body when one of its tokens starts with
+it, those tokens are found by bisecting the sorted vocabulary, so
+neither the bodies nor the whole vocabulary are scanned.
+"""
+import re
+
+import bisect
+
+_tokens = re.compile(r'[\w@]+')
+
+LABEL_SCORE = 4
+LABEL_PREFIX_SCORE = 2
+CONTEXT_SCORE = 2
+BODY_SCORE = 1
+
+
+def tokenize(text):
+    """Return the unique lower case tokens of a snippet body, bare numbers
+    are left out"""
+    return frozenset(
+        x for x in _tokens.findall(text.lower()) if not x.isdigit())
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class SearchIndex(object):
+    """Index of snippets by label.
+
+    Partial indexes can be built off the GUI thread, e.g. per loaded
+    batch, and folded into the live index with merge.
+    """
+    def __init__(self):
+        self._labels = {}  # label -> lower case label
+        self._contexts = {}  # label -> lower case context
+        self._by_context = {}  # lower case context -> labels
+        self._terms = {}  # label -> body tokens
+        self._trigrams = {}  # trigram -> labels
+        self._postings = {}  # body token -> labels
+        self._vocabulary = None  # sorted body tokens, built when searched
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __contains__(self, label):
+        return label in self._labels
+
+    def terms(self, label):
+        return self._terms.get(label)
+
+    def add(self, snippet):
+        """Index a snippet, using its stored terms when it has them"""
+        terms = snippet.terms
+        if terms is None:
+            terms = snippet.terms = tokenize(snippet.data)
+
+        label = snippet.label
+        if label in self._labels:
+            self.remove(label)
+        lower = label.lower()
+        self._labels[label] = lower
+        context = snippet.context.lower()
+        self._contexts[label] = context
+        self._by_context.setdefault(context, set()).add(label)
+        self._terms[label] = terms
+        for trigram in trigrams(lower):
+            self._trigrams.setdefault(trigram, set()).add(label)
+        for term in terms:
+            labels = self._postings.get(term)
+            if labels is None:
+                self._postings[term] = set([label])
+                self._vocabulary = None
+            else:
+                labels.add(label)
+
+    def remove(self, label):
+        lower = self._labels.pop(label, None)
+        if lower is None:
+            return
+        self._discard(self._by_context, self._contexts.pop(label), label)
+        for trigram in trigrams(lower):
+            self._discard(self._trigrams, trigram, label)
+        for term in self._terms.pop(label):
+            if self._discard(self._postings, term, label):
+                self._vocabulary = None
+
+    def update(self, snippet):
+        """Re-index a snippet after its body or context changed"""
+        self.remove(snippet.label)
+        snippet.terms = tokenize(snippet.data)
+        self.add(snippet)
+
+    def rename(self, old_label, snippet):
+        """Move an entry to a new label, the body is not re-tokenized"""
+        terms = self._terms.get(old_label)
+        self.remove(old_label)
+        if terms is not None:
+            snippet.terms = terms
+        self.add(snippet)
+
+    def merge(self, other):
+        """Fold another index into this one, its entries replace those of
+        the same labels"""
+        for label in other._labels:
+            if label in self._labels:
+                self.remove(label)
+        if other._postings:
+            self._vocabulary = None
+        self._labels.update(other._labels)
+        self._contexts.update(other._contexts)
+        self._terms.update(other._terms)
+        tables = ((self._by_context, other._by_context),
+                  (self._trigrams, other._trigrams),
+                  (self._postings, other._postings))
+        for table, other_table in tables:
+            for key, labels in other_table.items():
+                existing = table.get(key)
+                if existing is None:
+                    table[key] = set(labels)
+                else:
+                    existing.update(labels)
+
+    def search(self, text, within=None):
+        """Return {label: score} for every snippet matching all words of text.
+
+        within optionally limits the search to a collection of labels,
+        e.g. the results of a shorter query this one extends.
+        """
+        scores = None
+        for word in text.lower().split():
+            hits = self._search_word(word, within)
+            if scores is None:
+                scores = hits
+            else:
+                scores = dict(
+                    (x, scores[x] + hits[x]) for x in scores if x in hits)
+            if not scores:
+                break
+        return scores or {}
+
+    def score(self, label, text):
+        """Score a single indexed snippet against text, 0 if it misses"""
+        if label not in self._labels:
+            return 0
+        total = 0
+        for word in text.lower().split():
+            score = self._score_word(label, word)
+            if not score:
+                return 0
+            total += score
+        return total
+
+    def _search_word(self, word, within):
+        hits = {}
+        if len(word) >= 3 and within is None:
+            pools = [self._trigrams.get(x, set()) for x in trigrams(word)]
+            pools.sort(key=len)
+            labels = pools[0].intersection(*pools[1:])
+        else:
+            labels = self._labels if within is None else within
+        for label in labels:
+            lower = self._labels.get(label)
+            if lower is not None and word in lower:
+                score = LABEL_SCORE
+                if lower.startswith(word):
+                    score += LABEL_PREFIX_SCORE
+                hits[label] = score
+
+        pools = [(labels, CONTEXT_SCORE)
+                 for context, labels in self._by_context.items()
+                 if word in context]
+        pools.extend((self._postings[x], BODY_SCORE)
+                     for x in self._prefixed(word))
+        for labels, score in pools:
+            for label in labels:
+                if label not in hits:
+                    if within is None or label in within:
+                        hits[label] = score
+        return hits
+
+    def _prefixed(self, word):
+        """Return the body tokens starting with word"""
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        vocabulary = self._vocabulary
+        terms = []
+        for i in range(bisect.bisect_left(vocabulary, word), len(vocabulary)):
+            if not vocabulary[i].startswith(word):
+                break
+            terms.append(vocabulary[i])
+        return terms
+
+    def _score_word(self, label, word):
+        lower = self._labels[label]
+        if word in lower:
+            if lower.startswith(word):
+                return LABEL_SCORE + LABEL_PREFIX_SCORE
+            return LABEL_SCORE
+        if word in self._contexts[label]:
+            return CONTEXT_SCORE
+        for term in self._terms[label]:
+            if term.startswith(word):
+                return BODY_SCORE
+        return 0
+
+    def _discard(self, table, key, label):
+        """Remove label from a table entry, return True if the entry went
+        away with it"""
+        labels = table.get(key)
+        if labels is not None:
+            labels.discard(label)
+            if not labels:
+                del table[key]
+                return True
+        return False
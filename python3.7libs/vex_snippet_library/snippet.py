@@ -0,0 +1,350 @@
+import re
+
+import sys
+
+import string
+
+import array
+
+import weakref
+
+import threading
+
+import collections
+
+_digits = re.compile('([0-9]+)')
+
+
+def natural_key(text):
+    """Sort key that orders text the way humans expect, a2 before a10"""
+    parts = _digits.split(text.lower())
+    parts[1::2] = [int(x) for x in parts[1::2]]
+    return tuple(parts)
+
+
+def clean_label(label):
+    """Return a label the way rows store it, spaces as underscores"""
+    return label.strip().replace(' ', '_')
+
+
+def split_label(label):
+    """Split a label into its base name and numeric suffix"""
+    head = label.rstrip(string.digits)
+    tail = label[len(head):]
+    return head, int(tail) if tail else 0
+
+
+class UniqueLabels(object):
+    """Labels in use, and the next free numbered variant of a label.
+
+    Suffixes freed by discarding labels are not reused.
+    """
+    def __init__(self):
+        self._labels = set()
+        self._suffixes = {}  # base name -> highest numeric suffix in use
+
+    def __contains__(self, label):
+        return label in self._labels
+
+    def unique(self, label):
+        """Return label cleaned, or the next free numbered variant"""
+        label = clean_label(label)
+        if label not in self._labels:
+            return label
+        head, digit = split_label(label)
+        return '{}{}'.format(head, self._suffixes[head] + 1)
+
+    def add(self, label):
+        self._labels.add(label)
+        head, digit = split_label(label)
+        if digit > self._suffixes.get(head, -1):
+            self._suffixes[head] = digit
+
+    def discard(self, label):
+        self._labels.discard(label)
+
+
+class BodyCache(object):
+    """Least recently used snippet bodies, at most budget characters"""
+    def __init__(self, budget=16 * 1024 * 1024):
+        self.budget = budget
+        self._bodies = collections.OrderedDict()  # snippet -> body
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._bodies)
+
+    def get(self, snippet):
+        with self._lock:
+            body = self._bodies.get(snippet)
+            if body is not None:
+                self._bodies.move_to_end(snippet)
+            return body
+
+    def put(self, snippet, body):
+        with self._lock:
+            old = self._bodies.pop(snippet, None)
+            if old is not None:
+                self._size -= len(old)
+            self._bodies[snippet] = body
+            self._size += len(body)
+            while self._size > self.budget and len(self._bodies) > 1:
+                snippet, old = self._bodies.popitem(last=False)
+                self._size -= len(old)
+
+    def discard(self, snippet):
+        with self._lock:
+            old = self._bodies.pop(snippet, None)
+            if old is not None:
+                self._size -= len(old)
+
+    def size(self):
+        return self._size
+
+
+bodies = BodyCache()  # shared by every LazySnippet
+
+
+class Snippet(object):
+    __slots__ = ('_label', 'sort_key', 'context', 'data', 'new_name', 'terms',
+                 'source', '__weakref__')
+
+    def __init__(self, input_dict):
+        self.label = input_dict['label']
+        self.context = sys.intern(input_dict['context'])
+        self.data = input_dict['data']
+        self.new_name = ''
+        self.terms = None  # search tokens of data, see search_index
+        # where the store keeps it, a file path or a row key, labels can
+        # differ from it once made unique
+        self.source = None
+
+    @property
+    def label(self):
+        return self._label
+
+    @label.setter
+    def label(self, value):
+        self._label = sys.intern(value)
+        self.sort_key = natural_key(value)
+
+    def to_dict(self):
+        return {
+            'label': self.label,
+            'context': self.context,
+            'data': self.data
+        }
+
+    def loaded_data(self):
+        """Return data if it is in memory, None if it would be fetched"""
+        return self.data
+
+
+class LazySnippet(Snippet):
+    """Snippet whose data is fetched from storage when it is accessed.
+
+    Data is fetched with fetch(source) and kept in the shared body cache,
+    it is fetched again once evicted. Data assigned to the snippet, e.g.
+    by saving an edit, stays with it.
+    """
+    __slots__ = ('_data', '_fetch')
+
+    def __init__(self, label, context, fetch, source, terms=None):
+        self._data = None
+        self._fetch = fetch
+        super(LazySnippet, self).__init__(
+            {'label': label, 'context': context, 'data': None})
+        self.terms = terms
+        self.source = source
+
+    @property
+    def data(self):
+        if self._data is not None:
+            return self._data
+        data = bodies.get(self)
+        if data is None:
+            data = self._fetch(self.source)
+            bodies.put(self, data)
+        return data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        if value is not None:
+            bodies.discard(self)
+
+    def loaded_data(self):
+        if self._data is not None:
+            return self._data
+        return bodies.get(self)
+
+
+class SnippetList(list):
+    """Rows of SnippetModel as one Snippet object per row"""
+    def label(self, row):
+        return self[row].label
+
+    def context(self, row):
+        return self[row].context
+
+    def labels(self):
+        return [x.label for x in self]
+
+    def insert_many(self, pos, snippets):
+        self[pos:pos] = snippets
+
+
+class SnippetColumns(object):
+    """Rows of SnippetModel stored column by column.
+
+    Labels are interned strings and contexts small integer codes into a
+    table of context names. Bodies in memory are held by offset in a
+    single utf-8 buffer, bodies left in storage by a code into a table of
+    fetch functions. Snippet objects are only built when a row is
+    accessed and are shared for as long as anything holds on to them.
+    Changes made to them are stored by assigning them back to their row,
+    transient fields like new_name live only as long as the object.
+    """
+    compact_after = 1024 * 1024  # bytes of replaced bodies in the buffer
+
+    def __init__(self, snippets=()):
+        self._labels = []
+        self._sources = []
+        self._contexts = array.array('H')
+        self._context_names = []
+        self._context_codes = {}
+        # body offset in _text, or -1 - code of the fetch function
+        self._offsets = array.array('q')
+        self._lengths = array.array('q')
+        self._fetchers = []
+        self._fetcher_codes = {}
+        self._text = bytearray()
+        self._garbage = 0
+        self._live = weakref.WeakValueDictionary()  # label -> snippet
+        self.insert_many(0, list(snippets))
+
+    def __len__(self):
+        return len(self._labels)
+
+    def __iter__(self):
+        for row in range(len(self._labels)):
+            yield self[row]
+
+    def __getitem__(self, row):
+        label = self._labels[row]
+        snippet = self._live.get(label)
+        if snippet is None:
+            snippet = self._build(row)
+            self._live[label] = snippet
+        return snippet
+
+    def __setitem__(self, row, snippet):
+        old_label = self._labels[row]
+        self._drop_body(row)
+        offset, length = self._store_body(snippet)
+        self._labels[row] = snippet.label
+        self._sources[row] = snippet.source
+        self._contexts[row] = self._context_code(snippet.context)
+        self._offsets[row] = offset
+        self._lengths[row] = length
+        if self._live.get(old_label) is snippet:
+            del self._live[old_label]
+        self._live[snippet.label] = snippet
+        self._compact()
+
+    def label(self, row):
+        return self._labels[row]
+
+    def context(self, row):
+        return self._context_names[self._contexts[row]]
+
+    def labels(self):
+        return self._labels
+
+    def insert(self, pos, snippet):
+        """Insert a single row, snippet stays the object of that row"""
+        self.insert_many(pos, [snippet])
+        self._live[snippet.label] = snippet
+
+    def insert_many(self, pos, snippets):
+        labels = []
+        sources = []
+        contexts = array.array('H')
+        offsets = array.array('q')
+        lengths = array.array('q')
+        for snippet in snippets:
+            offset, length = self._store_body(snippet)
+            labels.append(snippet.label)
+            sources.append(snippet.source)
+            contexts.append(self._context_code(snippet.context))
+            offsets.append(offset)
+            lengths.append(length)
+        self._labels[pos:pos] = labels
+        self._sources[pos:pos] = sources
+        self._contexts[pos:pos] = contexts
+        self._offsets[pos:pos] = offsets
+        self._lengths[pos:pos] = lengths
+
+    def pop(self, row):
+        snippet = self[row]
+        self._drop_body(row)
+        self._live.pop(self._labels[row], None)
+        del self._labels[row]
+        del self._sources[row]
+        del self._contexts[row]
+        del self._offsets[row]
+        del self._lengths[row]
+        self._compact()
+        return snippet
+
+    def _build(self, row):
+        label = self._labels[row]
+        context = self._context_names[self._contexts[row]]
+        source = self._sources[row]
+        offset = self._offsets[row]
+        if offset < 0:
+            return LazySnippet(
+                label, context, self._fetchers[-1 - offset], source)
+        body = self._text[offset:offset + self._lengths[row]]
+        snippet = Snippet(
+            {'label': label, 'context': context, 'data': body.decode('utf-8')})
+        snippet.source = source
+        return snippet
+
+    def _context_code(self, context):
+        code = self._context_codes.get(context)
+        if code is None:
+            code = self._context_codes[context] = len(self._context_names)
+            self._context_names.append(sys.intern(context))
+        return code
+
+    def _store_body(self, snippet):
+        if isinstance(snippet, LazySnippet) and snippet._data is None:
+            # bound methods of the same store compare equal
+            code = self._fetcher_codes.get(snippet._fetch)
+            if code is None:
+                code = self._fetcher_codes[snippet._fetch] = len(
+                    self._fetchers)
+                self._fetchers.append(snippet._fetch)
+            return -1 - code, 0
+        body = snippet.data.encode('utf-8')
+        offset = len(self._text)
+        self._text += body
+        return offset, len(body)
+
+    def _drop_body(self, row):
+        if self._offsets[row] >= 0:
+            self._garbage += self._lengths[row]
+
+    def _compact(self):
+        if (self._garbage < self.compact_after or
+                self._garbage < len(self._text) // 2):
+            return
+        text = bytearray()
+        for row, offset in enumerate(self._offsets):
+            if offset >= 0:
+                self._offsets[row] = len(text)
+                text += self._text[offset:offset + self._lengths[row]]
+        self._text = text
+        self._garbage = 0
@@ -0,0 +1,437 @@
+import os
+
+import json
+
+import time
+
+import uuid
+
+import sqlite3
+
+import logging
+
+from contextlib import closing
+
+from .snippet import (
+    Snippet, LazySnippet, UniqueLabels, clean_label, natural_key)
+
+from .search_index import tokenize
+
+from .profiler import profiler
+
+logger = logging.getLogger('vex_snippet_library.main_panel.storage')
+
+
+def write_json(path, obj, **kwargs):
+    """Write through a temporary file that replaces path once it is on
+    disk, a crash never leaves a truncated file"""
+    temp = '{}.{}.tmp'.format(path, uuid.uuid4().hex[:8])
+    try:
+        with open(temp, 'w') as f:
+            json.dump(obj, f, **kwargs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+    except OSError:
+        if os.path.isfile(temp):
+            os.remove(temp)
+        raise
+
+
+class DirectoryStore(object):
+    """One json file per snippet, json/<label>.json.
+
+    After a load the label, context and search terms of every file are
+    written to a manifest, stamped with the file's mtime and size. The
+    next scan only parses files whose stamp changed, the others are
+    read from the manifest and their data when it is first accessed.
+    """
+    manifest_version = 1
+
+    def __init__(self, json_path, manifest_path=None):
+        self.json_path = json_path
+        self.manifest_path = manifest_path
+        self._dirs = [json_path]  # directories found by the last stamps
+        self._stamps = {}  # path -> stamp, of the last scan
+        self._records = {}  # path -> manifest record still valid
+        self._loaded = None  # path -> record read since the last scan
+        self._dirty = False
+        if not os.path.isdir(self.json_path):
+            os.makedirs(self.json_path)
+
+    def path(self, label):
+        return os.path.join(self.json_path, '{}.json'.format(label))
+
+    def source(self, label, taken=()):
+        """Return the source of a new snippet, a path no other file or
+        source in taken uses"""
+        return self._free_path(label, taken)
+
+    def _free_path(self, label, taken=(), own=None):
+        """Return the path of label, numbered label_1, label_2... while
+        it belongs to a file other than own, e.g. one whose stored label
+        differs from its name"""
+        path = self.path(label)
+        suffix = 0
+        while path in taken or self._occupied(path, own):
+            suffix += 1
+            path = self.path('{}_{}'.format(label, suffix))
+        return path
+
+    def _occupied(self, path, own):
+        if not os.path.lexists(path):
+            return False
+        # a rename changing only the case is the same file on
+        # case-insensitive file systems
+        return own is None or not (
+            os.path.exists(own) and os.path.samefile(path, own))
+
+    def _file(self, snippet):
+        return snippet.source or self.path(snippet.label)
+
+    def label(self, entry):
+        return os.path.splitext(os.path.basename(entry))[0]
+
+    def scan(self):
+        """Return the paths of every snippet file, in label order"""
+        self._stamps = self.stamps()
+        manifest = self.read_manifest()
+        self._records = {}
+        start = len(os.path.join(self.json_path, ''))
+        for path, stamp in self._stamps.items():
+            record = manifest.get(path[start:])  # relative to json_path
+            if record is not None and tuple(record[:2]) == stamp:
+                self._records[path] = record
+        self._loaded = {}
+        self._dirty = len(self._records) != len(manifest)
+        return sorted(self._stamps, key=lambda x: natural_key(self.label(x)))
+
+    def read(self, entry):
+        if self._loaded is None:  # not part of a scan, e.g. the watcher
+            return self._parse(entry)
+        record = self._records.get(entry)
+        if record is None:
+            # only the header and terms stay in memory, the body is
+            # fetched again when it is needed
+            parsed = self._parse(entry)
+            terms = tokenize(parsed.data)
+            mtime, size = self._stamps[entry]
+            record = [mtime, size, parsed.label, parsed.context,
+                      ' '.join(sorted(terms))]
+            self._dirty = True
+        else:
+            terms = frozenset(record[4].split())
+        self._loaded[entry] = record
+        return LazySnippet(
+            record[2], record[3], self.read_data, entry, terms)
+
+    def _load(self, path):
+        with profiler.span('parse'):
+            with open(path, 'r') as f:
+                text = f.read()
+            profiler.count('bytes_read', len(text))
+            return json.loads(text)
+
+    def _parse(self, entry):
+        snippet = Snippet(self._load(entry))
+        snippet.source = entry
+        return snippet
+
+    def read_data(self, path):
+        try:
+            return self._load(path)['data']
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Could not read snippet {}: {}'.format(path, e))
+            return ''
+
+    def read_manifest(self):
+        """Return {relative path: record} from the manifest, if any"""
+        if self.manifest_path is None:
+            return {}
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('version') != self.manifest_version:
+            return {}
+        return manifest['snippets']
+
+    def write_manifest(self):
+        """Write the manifest of the snippets read since the last scan,
+        unless it would not change"""
+        loaded, self._loaded = self._loaded, None
+        self._records = {}
+        if self.manifest_path is None or not loaded or not self._dirty:
+            return
+        start = len(os.path.join(self.json_path, ''))
+        snippets = dict((x[start:], y) for x, y in loaded.items())
+        write_json(self.manifest_path, {
+            'version': self.manifest_version, 'snippets': snippets})
+        logger.debug('Wrote manifest of {} snippets'.format(len(snippets)))
+
+    def stamps(self):
+        """Return {path: (mtime, size)} of every snippet file"""
+        stamps = {}
+        dirs = [self.json_path]
+        found = []
+        while dirs:
+            path = dirs.pop()
+            found.append(path)
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            dirs.append(entry.path)
+                        elif entry.name.endswith('.json'):
+                            try:
+                                stat = entry.stat()
+                            except OSError:  # removed while scanning
+                                continue
+                            stamps[entry.path] = (
+                                stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                logger.debug('Could not scan {}'.format(path))
+        self._dirs = found
+        return stamps
+
+    def version(self):
+        """Cheap change check, the mtimes of the library directories.
+
+        Adding, removing and replacing files changes it, a file edited in
+        place does not.
+        """
+        version = []
+        for path in self._dirs:
+            try:
+                version.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def watch_paths(self):
+        return list(self._dirs)
+
+    def entry(self, key):
+        """Return the scan entry of a stamps key"""
+        return key
+
+    def write(self, snippet):
+        write_json(self._file(snippet), snippet.to_dict(), indent=4)
+
+    def write_many(self, snippets):
+        for snippet in snippets:
+            self.write(snippet)
+
+    def delete(self, snippet):
+        path = self._file(snippet)
+        if not os.path.isfile(path):
+            return False
+        os.remove(path)
+        return True
+
+    def rename(self, snippet, new_label):
+        """Move a snippet's file to its new label, return its new source.
+
+        The file is never moved over another one, it gets a numbered name
+        instead.
+        """
+        old = self._file(snippet)
+        path = self._free_path(new_label, own=old)
+        os.rename(old, path)
+        return path
+
+
+class PackedStore(object):
+    """All snippets in a single SQLite file.
+
+    Labels and contexts are read through a covering index in one pass at
+    startup, snippet bodies are only fetched when a snippet is accessed.
+    The search tokens of each body live in their own table so the search
+    index can be built without reading any bodies.
+    """
+    schema = (
+        '''
+        CREATE TABLE IF NOT EXISTS snippets (
+            label TEXT PRIMARY KEY,
+            context TEXT NOT NULL,
+            data TEXT NOT NULL,
+            mtime REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS snippet_headers
+        ON snippets (label, context)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS snippet_terms (
+            label TEXT PRIMARY KEY,
+            terms TEXT NOT NULL
+        )
+        '''
+    )
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with closing(self._connect()) as db, db:
+            for statement in self.schema:
+                db.execute(statement)
+            # stores written before snippet_terms existed
+            missing = db.execute(
+                'SELECT label, data FROM snippets WHERE label NOT IN '
+                '(SELECT label FROM snippet_terms)').fetchall()
+            db.executemany(
+                'INSERT INTO snippet_terms (label, terms) VALUES (?, ?)',
+                [(x, ' '.join(tokenize(y))) for x, y in missing])
+
+    def _connect(self):
+        # connections are cheap and may not be shared across threads
+        return sqlite3.connect(self.db_path)
+
+    def scan(self):
+        """Return (label, context, terms) of every snippet, in label order"""
+        with closing(self._connect()) as db:
+            rows = db.execute(
+                'SELECT label, context FROM snippets '
+                'INDEXED BY snippet_headers').fetchall()
+            terms = dict(db.execute(
+                'SELECT label, terms FROM snippet_terms').fetchall())
+        rows = [(x, y, terms.get(x)) for x, y in rows]
+        return sorted(rows, key=lambda x: natural_key(x[0]))
+
+    def read(self, entry):
+        label, context, terms = entry
+        if terms is not None:
+            terms = frozenset(terms.split())
+        return LazySnippet(label, context, self.read_data, label, terms)
+
+    def label(self, entry):
+        return entry
+
+    def source(self, label, taken=()):
+        return label
+
+    def _key(self, snippet):
+        return snippet.source or snippet.label
+
+    def stamps(self):
+        """Return {label: mtime} of every snippet"""
+        with closing(self._connect()) as db:
+            return dict(db.execute('SELECT label, mtime FROM snippets'))
+
+    def version(self):
+        version = []
+        for path in (self.db_path, self.db_path + '-wal'):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def watch_paths(self):
+        return [self.db_path]
+
+    def entry(self, key):
+        """Return the scan entry of a stamps key"""
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT snippets.context, snippet_terms.terms '
+                'FROM snippets LEFT JOIN snippet_terms '
+                'ON snippets.label = snippet_terms.label '
+                'WHERE snippets.label = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return (key, row[0], row[1])
+
+    def write_manifest(self):
+        """Nothing to do, headers are read through an index"""
+
+    def read_data(self, key):
+        with closing(self._connect()) as db:
+            row = db.execute(
+                'SELECT data FROM snippets WHERE label = ?',
+                (key,)).fetchone()
+        if not row:
+            return ''
+        profiler.count('bytes_read', len(row[0]))
+        return row[0]
+
+    def write(self, snippet):
+        self.write_many([snippet])
+
+    def write_many(self, snippets):
+        rows = [(self._key(x), x.context, x.data, time.time())
+                for x in snippets]
+        terms = [(self._key(x), ' '.join(tokenize(x.data)))
+                 for x in snippets]
+        with closing(self._connect()) as db, db:
+            db.executemany(
+                'INSERT OR REPLACE INTO snippets '
+                '(label, context, data, mtime) VALUES (?, ?, ?, ?)', rows)
+            db.executemany(
+                'INSERT OR REPLACE INTO snippet_terms (label, terms) '
+                'VALUES (?, ?)', terms)
+
+    def delete(self, snippet):
+        key = self._key(snippet)
+        with closing(self._connect()) as db, db:
+            db.execute('DELETE FROM snippet_terms WHERE label = ?', (key,))
+            cursor = db.execute(
+                'DELETE FROM snippets WHERE label = ?', (key,))
+            return cursor.rowcount > 0
+
+    def rename(self, snippet, new_label):
+        """Relabel a snippet, keeping its mtime so that watchers see the
+        change as a rename"""
+        key = self._key(snippet)
+        with closing(self._connect()) as db, db:
+            db.execute(
+                'UPDATE snippets SET label = ? WHERE label = ?',
+                (new_label, key))
+            db.execute(
+                'UPDATE snippet_terms SET label = ? WHERE label = ?',
+                (new_label, key))
+        return new_label
+
+
+def migrate(json_path, db_path):
+    """Copy a json/ directory library into a new packed store.
+
+    Only runs once, an existing packed store is never overwritten. The
+    json files are left in place.
+    """
+    if os.path.isfile(db_path) or not os.path.isdir(json_path):
+        return False
+    source = DirectoryStore(json_path)
+    labels = UniqueLabels()
+    snippets = []
+    for path in source.scan():
+        try:
+            # parsed once, without the path as its source
+            snippet = Snippet(source._load(path))
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning('Skipping snippet {}: {}'.format(path, e))
+            continue
+        # labels are the keys of the packed store, the model would show
+        # a colliding one under a numbered variant
+        label = labels.unique(snippet.label)
+        if label != clean_label(snippet.label):
+            logger.warning('Migrating {} as {}, its label {} is taken'.format(
+                path, label, snippet.label))
+            snippet.label = label
+        labels.add(label)
+        snippets.append(snippet)
+    PackedStore(db_path).write_many(snippets)
+    logger.info('Migrated {} snippets to {}'.format(len(snippets), db_path))
+    return True
+
+
+def open_store(root, kind='directory'):
+    json_path = os.path.join(root, 'json')
+    if kind == 'packed':
+        db_path = os.path.join(root, 'snippets.db')
+        migrate(json_path, db_path)
+        return PackedStore(db_path)
+    return DirectoryStore(
+        json_path, os.path.join(root, 'json_manifest.json'))
@@ -0,0 +1,24 @@
+"""Signals of the tasks run on the global thread pool.
+
+A task can outlive the object that started it, e.g. a library closed
+while its writes are still running. Its signals are therefore a QObject
+without a parent, forwarded to the owner's signals of the same names,
+and emitting them once they were deleted is not an error.
+"""
+from PySide2 import QtCore
+
+
+class TaskSignals(QtCore.QObject):
+    """Base class of the signals a task emits from a pool thread"""
+    def forward(self, owner, *names):
+        """Connect the signals names to those of owner"""
+        for name in names:
+            getattr(self, name).connect(getattr(owner, name))
+
+    def send(self, name, *args):
+        """Emit the signal name, return False if the signals are gone"""
+        try:
+            getattr(self, name).emit(*args)
+        except RuntimeError:
+            return False
+        return True
@@ -0,0 +1,211 @@
+import logging
+
+import sqlite3
+
+from PySide2 import QtCore
+
+from .search_index import tokenize
+
+from .tasks import TaskSignals
+
+from .profiler import profiler
+
+logger = logging.getLogger('vex_snippet_library.main_panel.watcher')
+
+
+class LibraryChanges(object):
+    """Snippets changed on disk since the previous scan.
+
+    removed holds sources, renamed holds (old source, snippet) pairs and
+    snippets the added or changed snippets, already read and tokenized.
+    Snippets keep the label stored with them, like a load.
+    """
+    def __init__(self, removed, renamed, snippets):
+        self.removed = removed
+        self.renamed = renamed
+        self.snippets = snippets
+
+    def __bool__(self):
+        return bool(self.removed or self.renamed or self.snippets)
+
+
+class WatcherSignals(TaskSignals):
+    scanned = QtCore.Signal(int, object, object)
+
+
+class ScanTask(QtCore.QRunnable):
+    """Compares the store's stamps with the previous scan on a pool thread.
+
+    Only added and changed entries are read. A removed and an added entry
+    sharing a stamp is a rename, os.rename keeps mtime and size.
+    """
+    def __init__(self, store, previous, generation, signals):
+        super(ScanTask, self).__init__()
+        self.store = store
+        self.previous = previous
+        self.generation = generation
+        self.signals = signals
+
+    def run(self):
+        try:
+            with profiler.span('watch_scan'):
+                result = self.scan()
+            self.signals.send('scanned', self.generation, *result)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning('Could not scan the library: {}'.format(e))
+            self.signals.send('scanned', self.generation, None, None)
+
+    def scan(self):
+        stamps = self.store.stamps()
+        if self.previous is None:  # first scan, nothing to compare to
+            return stamps, None
+
+        previous = self.previous
+        removed = [x for x in previous if x not in stamps]
+        read = [x for x in stamps if previous.get(x) != stamps[x]]
+        by_stamp = dict((previous[x], x) for x in removed)
+        moves = {}  # new key -> old key
+        for key in read:
+            old = by_stamp.pop(stamps[key], None)
+            if old is not None:
+                moves[key] = old
+
+        renamed = []
+        snippets = []
+        for key in read:
+            try:
+                snippet = self.store.read(self.store.entry(key))
+            except (OSError, ValueError, KeyError) as e:
+                # e.g. written in place by someone else, retry next scan
+                logger.debug('Could not read snippet {}: {}'.format(key, e))
+                if key in previous:
+                    stamps[key] = previous[key]
+                else:
+                    del stamps[key]
+                moves.pop(key, None)
+                continue
+            if snippet.terms is None:
+                snippet.terms = tokenize(snippet.data)
+            if key in moves:
+                renamed.append((moves[key], snippet))
+            else:
+                snippets.append(snippet)
+        moved = set(moves.values())
+        removed = [x for x in removed if x not in moved]
+        return stamps, LibraryChanges(removed, renamed, snippets)
+
+
+class LibraryWatcher(QtCore.QObject):
+    """Keeps a library in sync with snippets changed by other sessions.
+
+    Filesystem notifications trigger a scan shortly after the library
+    changes. Shared libraries on network drives may not send any, so the
+    store's version is also polled every interval seconds, a full scan of
+    the stamps only runs when it moved or every full_scan_every polls.
+    """
+    changed = QtCore.Signal(object)
+    notify_delay = 250  # ms, coalesces bursts of notifications
+    full_scan_every = 6
+
+    def __init__(self, store, parent=None):
+        super(LibraryWatcher, self).__init__(parent)
+        self.store = store
+        self._stamps = None
+        self._version = None
+        self._polls = 0
+        self._generation = 0
+        self._task = None
+        self._scanning = False
+        self._rescan = False
+        self._paused = False
+        self._signals = WatcherSignals()
+        self._signals.scanned.connect(self._scanned)
+
+        self._notifier = QtCore.QFileSystemWatcher(self)
+        self._notifier.directoryChanged.connect(self.schedule)
+        self._notifier.fileChanged.connect(self.schedule)
+        self._delay = QtCore.QTimer(self)
+        self._delay.setSingleShot(True)
+        self._delay.setInterval(self.notify_delay)
+        self._delay.timeout.connect(self.scan)
+        self._poll = QtCore.QTimer(self)
+        self._poll.timeout.connect(self.poll)
+
+    def start(self, interval=10):
+        """Take a first snapshot and start watching, interval in seconds,
+        0 relies on filesystem notifications alone"""
+        self._paused = False
+        self.scan()
+        if interval > 0:
+            self._poll.start(int(interval * 1000))
+
+    def stop(self):
+        self._poll.stop()
+        self._delay.stop()
+        paths = self._notifier.directories() + self._notifier.files()
+        if paths:
+            self._notifier.removePaths(paths)
+        self._paused = True
+        self._generation += 1
+
+    def pause(self):
+        """Hold back changes, e.g. while a snippet is being edited"""
+        self._paused = True
+        self._generation += 1
+
+    def resume(self):
+        self._paused = False
+        self.schedule()
+
+    def invalidate(self):
+        """Drop the results of a scan in flight and scan again, call after
+        changing the library from this session"""
+        self._generation += 1
+        if self._scanning:
+            self._rescan = True
+
+    def schedule(self, path=None):
+        self._delay.start()
+
+    def poll(self):
+        self._polls += 1
+        if (self._polls >= self.full_scan_every or
+                self.store.version() != self._version):
+            self.scan()
+
+    def scan(self):
+        if self._paused:
+            return
+        if self._scanning:
+            self._rescan = True
+            return
+        self._scanning = True
+        self._polls = 0
+        self._version = self.store.version()
+        self._task = ScanTask(
+            self.store, self._stamps, self._generation, self._signals)
+        self._task.setAutoDelete(False)
+        QtCore.QThreadPool.globalInstance().start(self._task)
+
+    def _scanned(self, generation, stamps, changes):
+        self._scanning = False
+        if generation == self._generation and stamps is not None:
+            self._stamps = stamps
+            self._watch()
+            if changes:
+                logger.debug('Library changed: {} removed, {} renamed, '
+                             '{} added or changed'.format(
+                                 len(changes.removed), len(changes.renamed),
+                                 len(changes.snippets)))
+                self.changed.emit(changes)
+        elif generation != self._generation:
+            self._rescan = True
+        if self._rescan:
+            self._rescan = False
+            self.scan()
+
+    def _watch(self):
+        watched = set(self._notifier.directories() + self._notifier.files())
+        paths = [x for x in self.store.watch_paths() if x not in watched]
+        if paths:
+            self._notifier.addPaths(paths)
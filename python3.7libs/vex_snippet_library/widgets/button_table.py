@@ -1,61 +1,111 @@
-import os
-
 import re
 
-import string
+import bisect
 
 import logging
 
 from PySide2 import QtCore, QtGui, QtWidgets
 
+from .. import icons
+
+from ..search_index import SearchIndex
+
+from ..snippet import (
+    natural_key, UniqueLabels, SnippetList, SnippetColumns)
+
+from ..profiler import profiler
+
 logger = logging.getLogger('vex_snippet_library.main_panel.button_table')
 
 
 class ButtonDelegate(QtWidgets.QStyledItemDelegate):
+    """Paints a copy button in each cell instead of creating a widget per row.
+
+    Clicks are handled in editorEvent, releasing the mouse over the button
+    that was pressed emits copyRequest.
+    """
     copyRequest = QtCore.Signal(QtCore.QModelIndex)
 
     def __init__(self, parent):
         super().__init__(parent)
+        self._pressed = QtCore.QPersistentModelIndex()
+
+    def button_rect(self, option):
+        row_height = self.parent().verticalHeader().defaultSectionSize()
+        size = int(row_height / 1.1)
+        rect = QtCore.QRect(0, 0, size, size)
+        rect.moveCenter(option.rect.center())
+        return rect
 
     def paint(self, painter, option, index):
-        if isinstance(self.parent(), QtWidgets.QAbstractItemView):
-            self.parent().openPersistentEditor(index)
         super(ButtonDelegate, self).paint(painter, option, index)
-
-    def createEditor(self, parent, option, index):
-        editor = QtWidgets.QPushButton(parent)
-        editor.setToolTip('Copy Snippet')
-        root = os.path.abspath(
-            os.path.join(os.path.abspath(__file__), '..', '..', '..', '..'))
-        icons = os.path.join(root, 'resources', 'icons')
-        icon = QtGui.QIcon(QtGui.QPixmap(os.path.join(icons, 'copy.png')))
-        editor.setIcon(icon)
-
-        table = self.parent()
-        row_height = table.verticalHeader().defaultSectionSize()
-        editor.setIconSize(QtCore.QSize(row_height/1.7, row_height/1.7))
-        editor.setFixedSize(row_height/1.1, row_height/1.1)
-        editor.clicked.connect(lambda: self.copyRequest.emit(index))
-        return editor
-
-    def setEditorData(self, editor, index):
-        pass
-
-    def setModelData(self, editor, model, index):
-        pass
-
-    def updateEditorGeometry(self, editor, option, index):
-        rect = option.rect
-        rect.setX(rect.x() + rect.width()/2-editor.size().width()/2)
-        rect.setY(rect.y() + rect.height()/2-editor.size().height()/2)
-        editor.setGeometry(rect)
+        row_height = self.parent().verticalHeader().defaultSectionSize()
+        icon_size = int(row_height / 1.7)
+
+        button = QtWidgets.QStyleOptionButton()
+        button.rect = self.button_rect(option)
+        button.icon = icons.icon('copy.png')
+        button.iconSize = QtCore.QSize(icon_size, icon_size)
+        button.state = option.state & QtWidgets.QStyle.State_Enabled
+        if self._pressed == index:
+            button.state |= QtWidgets.QStyle.State_Sunken
+        else:
+            button.state |= QtWidgets.QStyle.State_Raised
+
+        widget = option.widget
+        style = widget.style() if widget else QtWidgets.QApplication.style()
+        style.drawControl(
+            QtWidgets.QStyle.CE_PushButton, button, painter, widget)
+
+    def editorEvent(self, event, model, option, index):
+        press = (QtCore.QEvent.MouseButtonPress,
+                 QtCore.QEvent.MouseButtonDblClick)
+        if event.type() in press:
+            if (event.button() == QtCore.Qt.LeftButton and
+                    self.button_rect(option).contains(event.pos())):
+                self._pressed = QtCore.QPersistentModelIndex(index)
+                self.parent().viewport().update(option.rect)
+            return True  # never select from the button column
+        elif event.type() == QtCore.QEvent.MouseButtonRelease:
+            clicked = (self._pressed == index and
+                       self.button_rect(option).contains(event.pos()))
+            self._pressed = QtCore.QPersistentModelIndex()
+            self.parent().viewport().update(option.rect)
+            if clicked:
+                self.copyRequest.emit(index)
+            return True
+        return False
+
+    def helpEvent(self, event, view, option, index):
+        if event.type() == QtCore.QEvent.ToolTip:
+            QtWidgets.QToolTip.showText(
+                event.globalPos(), 'Copy Snippet', view)
+            return True
+        return super(ButtonDelegate, self).helpEvent(
+            event, view, option, index)
 
 
 class SnippetModel(QtCore.QAbstractTableModel):
+    """Snippets kept in natural label order.
+
+    Keeping the order here means the proxy never has to sort, so
+    filtering never re-sorts rows coming back into view. Rows are a
+    SnippetList of objects, use_columns switches to SnippetColumns.
+    """
     def __init__(self, parent=None):
         super(SnippetModel, self).__init__()
-        self.table_data = []
+        self.table_data = SnippetList()
         self.n_columns = 2
+        self._keys = []  # sort key per row, kept in step with table_data
+        self._labels = UniqueLabels()
+        self._sources = {}  # store source -> label of its row
+        self.search_index = SearchIndex()
+        self.moving = False  # a renamed row is removed and inserted again
+
+    def use_columns(self):
+        """Store rows column by column, see SnippetColumns"""
+        if not isinstance(self.table_data, SnippetColumns):
+            self.table_data = SnippetColumns(self.table_data)
 
     def rowCount(self, parent=QtCore.QModelIndex()):
         return len(self.table_data)
@@ -74,30 +124,18 @@ class SnippetModel(QtCore.QAbstractTableModel):
     def data(self, index, role):
         if not index.isValid():
             return None
-        item = self.table_data[index.row()]
+        rows = self.table_data
         if role == QtCore.Qt.DisplayRole:
             if index.column() == 1:  # button column
                 return None
-            return item.label
+            return rows.label(index.row())
         elif role == QtCore.Qt.UserRole:
-            return item
+            return rows[index.row()]
         elif role == QtCore.Qt.EditRole or role == QtCore.Qt.ToolTipRole:
-            return item.label
+            return rows.label(index.row())
         elif role == QtCore.Qt.DecorationRole:
             if index.column() == 0:
-                img = {
-                    'Detail': 'info.svg',
-                    'Points': 'filter_color_blue.svg',
-                    'Primitives': 'display_primitive_normals.svg',
-                    'Vertices': 'filter_color_purple.svg'
-                }
-                root = os.path.abspath(
-                    os.path.join(__file__, '..', '..', '..', '..'))
-                icons = os.path.join(root, 'resources', 'icons')
-                path = os.path.join(icons, img[item.context])
-                pxmap = QtGui.QPixmap(path)
-                icon = QtGui.QIcon(pxmap)
-                return icon
+                return icons.context_icon(rows.context(index.row()))
 
     def setData(self, index, value, role=QtCore.Qt.EditRole):
         if index.isValid():
@@ -113,60 +151,302 @@ class SnippetModel(QtCore.QAbstractTableModel):
                 self.dataChanged.emit(index, index, [QtCore.Qt.EditRole])
                 return True
             elif role == QtCore.Qt.UserRole:
+                self._unindex(item)
+                self._index(value)
+                self.search_index.remove(item.label)
+                self.search_index.update(value)
                 self.table_data[index.row()] = value
-                # self.dataChanged.emit(index, index, [QtCore.Qt.DecorationRole])
+                self.dataChanged.emit(index, index, [
+                    QtCore.Qt.DisplayRole, QtCore.Qt.DecorationRole])
                 return True
         else:
             return False
 
     def removeRows(self, pos, rows=1):
         self.beginRemoveRows(QtCore.QModelIndex(), pos, pos + rows - 1)
-        self.table_data.pop(pos)
+        item = self.table_data.pop(pos)
+        self._keys.pop(pos)
+        self._unindex(item)
+        self.search_index.remove(item.label)
         self.endRemoveRows()
         return True
 
     def insertRows(self, data):
-        n = self.rowCount()
-        self.beginInsertRows(QtCore.QModelIndex(), n, n)
-        data.label = self.build_unique_label(data.label)
-        self.table_data.append(data)
-        self.endInsertRows()
+        self.insert_batch([data])
+
+    def insert_batch(self, items, index=None):
+        """Insert snippets at their sorted rows.
+
+        One row insertion is emitted per run of adjacent new rows, a batch
+        that sorts after the existing rows is a single insertion. index is
+        an optional SearchIndex already built for the batch.
+        """
+        if not items:
+            return
+        with profiler.span('insert', rows=len(items)):
+            self._insert_batch(items, index)
+
+    def _insert_batch(self, items, index):
+        for item in items:
+            label = item.label
+            item.label = self.build_unique_label(label)
+            self._index(item)
+            if index is None:
+                self.search_index.add(item)
+            elif item.label != label:
+                if item.terms is not None and index.terms(label) is item.terms:
+                    index.rename(label, item)
+                else:
+                    index.add(item)
+        if index is not None:
+            self.search_index.merge(index)
+        items = sorted(items, key=lambda x: x.sort_key)
+
+        runs = []
+        for item in items:
+            pos = bisect.bisect_right(self._keys, item.sort_key)
+            if runs and runs[-1][0] == pos:
+                runs[-1][1].append(item)
+            else:
+                runs.append((pos, [item]))
+
+        # back to front so earlier positions stay valid
+        for pos, run in reversed(runs):
+            self.beginInsertRows(
+                QtCore.QModelIndex(), pos, pos + len(run) - 1)
+            self.table_data.insert_many(pos, run)
+            self._keys[pos:pos] = [x.sort_key for x in run]
+            self.endInsertRows()
+
+    def update_item(self, snippet):
+        """Copy context and data of snippet onto the row with its label.
+
+        Returns False when there is no such row or nothing changed, e.g.
+        a save of this panel coming back from the library watcher.
+        """
+        row = self.find_row(snippet.label)
+        if row == -1:
+            return False
+        item = self.table_data[row]
+        if (item.context == snippet.context and
+                item.loaded_data() == snippet.data):
+            return False
+        item.context = snippet.context
+        item.data = snippet.data
+        item.terms = snippet.terms
+        self.table_data[row] = item
+        self.search_index.remove(item.label)
+        self.search_index.add(item)
+        index = self.index(row, 0)
+        self.dataChanged.emit(
+            index, index, [QtCore.Qt.DisplayRole, QtCore.Qt.DecorationRole])
+        return True
+
+    def remove_label(self, label):
+        row = self.find_row(label)
+        if row == -1:
+            return False
+        return self.removeRows(row)
+
+    def rename(self, row, new_label, source=None):
+        """Relabel a row, moving it to keep the model sorted, source is
+        where the store moved the snippet to.
+
+        A move is emitted as the removal and insertion of that one row,
+        QSortFilterProxyModel answers row moves by remapping every row.
+        """
+        item = self.table_data[row]
+        old_label = item.label
+        self._unindex(item)
+        item.label = new_label
+        if source is not None:
+            item.source = source
+        self._index(item)
+        self.search_index.rename(old_label, item)
+        self._keys.pop(row)
+        pos = bisect.bisect_right(self._keys, item.sort_key)
+        self._keys.insert(row, item.sort_key)
+
+        if pos == row:
+            self.table_data[row] = item
+            index = self.index(row, 0)
+            self.dataChanged.emit(index, index, [QtCore.Qt.DisplayRole])
+            return row
+        parent = QtCore.QModelIndex()
+        self.moving = True
+        try:
+            self.beginRemoveRows(parent, row, row)
+            self.table_data.pop(row)
+            self._keys.pop(row)
+            self.endRemoveRows()
+            self.beginInsertRows(parent, pos, pos)
+            self.table_data.insert(pos, item)
+            self._keys.insert(pos, item.sort_key)
+            self.endInsertRows()
+        finally:
+            self.moving = False
+        return pos
+
+    def label(self, row):
+        return self.table_data.label(row)
+
+    def sort_key(self, row):
+        return self._keys[row]
+
+    def find_row(self, label):
+        """Return the row of a label, or -1, by bisecting the sort keys"""
+        if label not in self._labels:
+            return -1
+        row = bisect.bisect_left(self._keys, natural_key(label))
+        while self.table_data.label(row) != label:  # labels sharing a key
+            row += 1
+        return row
+
+    def search(self, text, within=None):
+        """Search the index, keeping only the labels of current rows"""
+        labels = self._labels
+        scores = self.search_index.search(text, within)
+        return dict((x, y) for x, y in scores.items() if x in labels)
+
+    def source_label(self, source):
+        """Return the label of the row read from a store source, or
+        None"""
+        return self._sources.get(source)
+
+    def sources(self):
+        """Return the store sources of every row"""
+        return self._sources.keys()
 
     def build_unique_label(self, input_str):
-        new_name = input_str.strip().replace(' ', '_')
-        data = self.table_data
-        labels = [x.label for x in data]
-        while(new_name in labels):
-            head = new_name.rstrip(string.digits)
-            tail = new_name.replace(head, '')
-            digit = int(tail) + 1 if tail else 1
-            new_name = '{}{}'.format(head, digit)
-        return new_name
+        """Return input_str, or the next free numbered variant of it.
+
+        Suffixes freed by deleting or renaming snippets are not reused.
+        """
+        return self._labels.unique(input_str)
+
+    def _index(self, item):
+        self._labels.add(item.label)
+        if item.source is not None:
+            self._sources[item.source] = item.label
+
+    def _unindex(self, item):
+        self._labels.discard(item.label)
+        self._sources.pop(item.source, None)
 
 
 class SnippetProxyModel(QtCore.QSortFilterProxyModel):
-    def __init(self, parent):
+    rank_limit = 500  # larger result sets keep the natural label order
+
+    def __init__(self, parent=None):
         super(SnippetProxyModel, self).__init__(parent)
+        self.filter_text = ''
+        self._scores = {}  # label -> search score under filter_text
+        self._ranks = {}  # label -> position of a ranked result
+        self._mask = None  # accepted flag per source row while refiltering
+
+    def setSourceModel(self, model):
+        # connected ahead of the base class so rows are refiltered with
+        # fresh scores
+        model.dataChanged.connect(self._source_data_changed)
+        super(SnippetProxyModel, self).setSourceModel(model)
+
+    def _source_data_changed(self, top_left, bottom_right, roles=()):
+        model = self.sourceModel()
+        for row in range(top_left.row(), bottom_right.row() + 1):
+            self._scores.pop(model.label(row), None)
+            self._ranks.pop(model.label(row), None)
+
+    def set_filter_text(self, text):
+        """Filter snippets by label, context and body through the model's
+        search index, best matches first.
+
+        Matches are computed up front so filterAcceptsRow is a list lookup
+        and ranked once, so lessThan compares two positions. When text
+        extends the previous filter only the snippets that are currently
+        accepted are searched again, and they are not sorted again when
+        their ranking kept its order.
+        """
+        text = text.lower()
+        if text == self.filter_text:
+            return
+        with profiler.span('filter', chars=len(text)):
+            self._set_filter_text(text)
+
+    def _set_filter_text(self, text):
+        model = self.sourceModel()
+        within = None
+        if self.filter_text and self.filter_text in text:
+            within = self._scores
+        scores = model.search(text, within) if text else {}
+        self.filter_text = text
+
+        order = []
+        if text and len(scores) <= self.rank_limit:
+            order = sorted(scores, key=lambda x: (-scores[x], natural_key(x)))
+        previous = [self._ranks.get(x, -1) for x in order]
+        narrowed = (within is not None and self.sortColumn() == 0 and
+                    -1 not in previous and previous == sorted(previous))
+        self._scores = scores
+        self._ranks = dict((x, i) for i, x in enumerate(order))
+
+        if not narrowed and self.sortColumn() != -1:
+            self.sort(-1)  # refilter in source order, rank once below
+        if text:
+            self._mask = [x in scores for x in model.table_data.labels()]
+        try:
+            if narrowed:  # drops rows, the rest keep their order
+                self.invalidateFilter()
+            else:
+                # rebuilding the mapping beats removing scattered rows
+                # one interval at a time
+                self.invalidate()
+        finally:
+            self._mask = None
+        if order and not narrowed:
+            self.sort(0)
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        with profiler.span('sort', column=column):
+            super(SnippetProxyModel, self).sort(column, order)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self._mask is not None:
+            return self._mask[source_row]
+        if not self.filter_text:
+            return True
+        return bool(self.score(self.sourceModel().label(source_row)))
+
+    def score(self, label):
+        score = self._scores.get(label)
+        if score is None:
+            # rows inserted or renamed after the filter was set
+            score = self.sourceModel().search_index.score(
+                label, self.filter_text)
+            self._scores[label] = score
+        return score
 
     def lessThan(self, left, right):
-        left_data = self.sourceModel().data(left, role=QtCore.Qt.DisplayRole)
-        right_data = self.sourceModel().data(right, role=QtCore.Qt.DisplayRole)
-        input_set = set([left_data, right_data])
-        sorted_set = self.sorted_nicely(input_set)
-        return right_data == sorted_set[0]
-
-    def sorted_nicely(self, input_set):
-        """ Sort the given iterable in the way that humans expect."""
-        conv = lambda text: int(text) if text.isdigit() else text.lower()
-        alphanum_key = lambda key: [conv(c) for c in re.split('([0-9]+)', key)]
-        return sorted(input_set, key=alphanum_key)
+        model = self.sourceModel()
+        left_label = model.label(left.row())
+        right_label = model.label(right.row())
+        left_rank = self._ranks.get(left_label)
+        right_rank = self._ranks.get(right_label)
+        if left_rank is not None and right_rank is not None:
+            return left_rank < right_rank
+        # rows inserted or changed after the filter was ranked
+        left_score = self.score(left_label)
+        right_score = self.score(right_label)
+        if left_score != right_score:
+            return left_score > right_score
+        return model.sort_key(left.row()) < model.sort_key(right.row())
 
 
 class ButtonTable(QtWidgets.QTableView):
-    def __init__(self, parent=None):
+    """View of a SnippetModel through its own filter, several tables may
+    share one model"""
+    def __init__(self, parent=None, model=None):
         super(ButtonTable, self).__init__(parent)
-        self.model = SnippetModel()
-        self.setModel(self.model)
+        self.model = model if model is not None else SnippetModel()
 
         self.filter = SnippetProxyModel(self)
         self.filter.setSourceModel(self.model)
@@ -176,7 +456,6 @@ class ButtonTable(QtWidgets.QTableView):
         btn_delegate = ButtonDelegate(self)
         btn_delegate.copyRequest.connect(self.btn_callback)
         self.setItemDelegateForColumn(1, btn_delegate)
-        self.model.rowsInserted.connect(self.scrollToBottom)
 
         v_header = self.verticalHeader()
         v_header.hide()
@@ -191,7 +470,6 @@ class ButtonTable(QtWidgets.QTableView):
 
         self.setSelectionMode(sel)
         self.setSelectionBehavior(beh)
-        self.setSortingEnabled(True)
         self.setShowGrid(False)
 
     def mousePressEvent(self, event):
@@ -203,21 +481,14 @@ class ButtonTable(QtWidgets.QTableView):
             index = self.indexAt(event.pos())
             if index.column() == 0:  # snippet select
                 super(ButtonTable, self).mousePressEvent(event)
-            elif index.column() == 1:  # column behind button
+            elif index.column() == 1:  # copy button
+                super(ButtonTable, self).mousePressEvent(event)
                 self.parent().add_btn.setFocus()  # focus fix
 
     def add_item(self, snippet):
-        self.model.beginResetModel()
         self.model.insertRows(snippet)
-        self.model.endResetModel()
-
-    def remove_item(self):
-        self.model.beginResetModel()
-        proxy_index = self.currentIndex()
-        model_index = self.filter.mapToSource(proxy_index)
-        r = model_index.row()
-        self.model.removeRows(r)
-        self.model.endResetModel()
+        model_idx = self.model.index(self.model.find_row(snippet.label), 0)
+        self.scrollTo(self.filter.mapFromSource(model_idx))
 
     def btn_callback(self, index):
         model_index = self.filter.mapToSource(index)
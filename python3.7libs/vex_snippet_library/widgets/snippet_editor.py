@@ -1,9 +1,9 @@
-import os
-
-from PySide2 import QtWidgets, QtCore, QtGui
+from PySide2 import QtWidgets
 
 from . import vex_editor
 
+from .. import icons
+
 
 class SnippetEditor(QtWidgets.QWidget):
     def __init__(self, parent=None):
@@ -13,14 +13,10 @@ class SnippetEditor(QtWidgets.QWidget):
 
     def _init_ui(self):
         self.layout = QtWidgets.QVBoxLayout(self)
-        root = os.path.abspath(os.path.join(__file__, '..', '..', '..', '..'))
-        icons = os.path.join(root, 'resources', 'icons')
 
         self.edit_btn = QtWidgets.QPushButton('')
         self.edit_btn.setToolTip('Allow Editing')
-        icon = QtGui.QIcon(
-            QtGui.QPixmap(os.path.join(icons, 'edit.png')))
-        self.edit_btn.setIcon(icon)
+        self.edit_btn.setIcon(icons.icon('edit.png'))
         self.edit_btn.clicked.connect(self.edit_btn_callback)
         self.edit_btn.setStyleSheet(
             '''
@@ -34,14 +30,12 @@ class SnippetEditor(QtWidgets.QWidget):
 
         self.save_btn = QtWidgets.QPushButton('')
         self.save_btn.setToolTip('Save Changes')
-        icon = QtGui.QIcon(os.path.join(icons, 'save.png'))
-        self.save_btn.setIcon(icon)
+        self.save_btn.setIcon(icons.icon('save.png'))
         self.save_btn.clicked.connect(self.save_btn_callback)
 
         self.cancel_btn = QtWidgets.QPushButton('')
         self.cancel_btn.setToolTip('Discard Changes')
-        icon = QtGui.QIcon(os.path.join(icons, 'cancel.png'))
-        self.cancel_btn.setIcon(icon)
+        self.cancel_btn.setIcon(icons.icon('cancel.png'))
         self.cancel_btn.clicked.connect(self.cancel_btn_callback)
 
         self.combo_lbl = QtWidgets.QLabel('Run Over')
@@ -2,10 +2,12 @@ import os
 
 import json
 
-from PySide2 import QtWidgets, QtGui, QtCore
+from PySide2 import QtWidgets, QtCore
 
 from . import button_table
 
+from .. import icons
+
 
 class ClickableLabel(QtWidgets.QLabel):
     clicked = QtCore.Signal(str)
@@ -19,8 +21,11 @@ class ClickableLabel(QtWidgets.QLabel):
 
 
 class SnippetViewer(QtWidgets.QWidget):
-    def __init__(self, parent=None):
+    filter_delay = 120  # ms of typing pause before the table is filtered
+
+    def __init__(self, parent=None, model=None):
         super(SnippetViewer, self).__init__(parent)
+        self.model = model
         self.icons = os.path.abspath(
             os.path.join(__file__, '..', '..', '..', '..', 'icons'))
         self.filter_text = ''
@@ -28,28 +33,25 @@ class SnippetViewer(QtWidgets.QWidget):
 
     def _init_ui(self):
         self.layout = QtWidgets.QVBoxLayout(self)
-        root = os.path.abspath(os.path.join(__file__, '..', '..', '..', '..'))
-        icons = os.path.join(root, 'resources', 'icons')
 
         self.add_btn = QtWidgets.QPushButton()
         self.add_btn.setToolTip('Add New Snippet')
-        icon = QtGui.QIcon(os.path.join(icons, 'add.svg'))
-        self.add_btn.setIcon(icon)
+        self.add_btn.setIcon(icons.icon('add.svg'))
 
         self.del_btn = QtWidgets.QPushButton()
         self.del_btn.setToolTip('Delete Selected Snippet')
-        icon = QtGui.QIcon(os.path.join(icons, 'delete.svg'))
-        self.del_btn.setIcon(icon)
+        self.del_btn.setIcon(icons.icon('delete.svg'))
 
         self.search_edit = QtWidgets.QLineEdit()
         self.search_edit.setPlaceholderText('Filter')
-        self.search_edit.textChanged.connect(self.filter_snippets)
+        self.filter_timer = QtCore.QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(self.filter_delay)
+        self.filter_timer.timeout.connect(self.filter_snippets)
+        self.search_edit.textChanged.connect(self.filter_timer.start)
 
         self.clear_btn = ClickableLabel(35, 35)
-        icon = QtGui.QIcon(
-            QtGui.QPixmap(os.path.join(icons, 'clear_filter.svg')))
-        pixmap = icon.pixmap(QtCore.QSize(64, 64))
-        self.clear_btn.setPixmap(pixmap)
+        self.clear_btn.setPixmap(icons.pixmap('clear_filter.svg', 64))
         self.clear_btn.clicked.connect(self.clear_btn_callback)
 
         btn_layout = QtWidgets.QHBoxLayout()
@@ -60,7 +62,7 @@ class SnippetViewer(QtWidgets.QWidget):
         search_layout.addWidget(self.search_edit)
         search_layout.addWidget(self.clear_btn)
 
-        self.table = button_table.ButtonTable()
+        self.table = button_table.ButtonTable(model=self.model)
         self.table.setStyleSheet(
             '''
             QTableView
@@ -75,18 +77,20 @@ class SnippetViewer(QtWidgets.QWidget):
             }
             ''')
 
+        self.progress_bar = QtWidgets.QProgressBar()
+        self.progress_bar.setFormat('Loading snippets.. %v / %m')
+        self.progress_bar.setMaximumHeight(14)
+        self.progress_bar.hide()
+
         self.layout.addLayout(btn_layout)
         self.layout.addLayout(search_layout)
         self.layout.addSpacing(5)
+        self.layout.addWidget(self.progress_bar)
         self.layout.addWidget(self.table)
 
     def filter_snippets(self):
-        self.table.model.beginResetModel()
-        self.table.filter.setFilterRegExp(QtCore.QRegExp(
-            self.search_edit.text(),
-            QtCore.Qt.CaseInsensitive,
-            QtCore.QRegExp.FixedString))
-        self.table.model.endResetModel()
+        self.filter_timer.stop()
+        self.table.filter.set_filter_text(self.search_edit.text())
 
     def setEnabled(self, mode=True):
         self.add_btn.setEnabled(mode)
@@ -94,5 +98,14 @@ class SnippetViewer(QtWidgets.QWidget):
         self.search_edit.setEnabled(mode)
         self.table.setEnabled(mode)
 
+    def set_progress(self, done, total):
+        if done >= total:
+            self.progress_bar.hide()
+            return
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.progress_bar.show()
+
     def clear_btn_callback(self):
         self.search_edit.setText('')
+        self.filter_snippets()
@@ -4,12 +4,31 @@ import re
 
 import logging
 
+import collections
+
 from PySide2 import QtWidgets, QtCore, QtGui
 
 from . import vex_highlighter
 
+from ..profiler import profiler
+
 logger = logging.getLogger('vex_snippet_library.main_panel.vex_editor')
 
+FONT_DIR = os.path.abspath(os.path.join(
+    __file__, '..', '..', '..', '..', 'resources', 'fonts'))
+_fonts_registered = False
+
+
+def register_fonts():
+    """Register the bundled fonts with Qt once per session"""
+    global _fonts_registered
+    if _fonts_registered:
+        return
+    with profiler.span('fonts'):
+        QtGui.QFontDatabase.addApplicationFont(
+            os.path.join(FONT_DIR, 'SourceCodePro-Regular.ttf'))
+    _fonts_registered = True
+
 
 class LineNumberArea(QtWidgets.QWidget):
     def __init__(self, editor):
@@ -18,9 +37,11 @@ class LineNumberArea(QtWidgets.QWidget):
         self.bg_color = QtGui.QColor(43, 43, 43)
         self.line_color = QtGui.QColor(75, 75, 75)
         self.num_color = QtGui.QColor(200, 200, 200)
+        self._atlas = None
+        self._atlas_key = None
 
     def sizeHint(self):
-        return QtCore.Qt.Qsize(self.editor._line_num_area_width(), 0)
+        return QtCore.QSize(self.myeditor._line_num_area_width(), 0)
 
     def paintEvent(self, event):
         self.myeditor.line_num_area_paint(event)
@@ -29,33 +50,143 @@ class LineNumberArea(QtWidgets.QWidget):
         self.bg_color = QtGui.QColor(83, 83, 83)
         self.line_color = QtGui.QColor(105, 105, 105)
         self.num_color = QtGui.QColor(200, 200, 200)
+        self.update()
 
     def enable(self):
         self.bg_color = QtGui.QColor(43, 43, 43)
         self.line_color = QtGui.QColor(75, 75, 75)
         self.num_color = QtGui.QColor(200, 200, 200)
+        self.update()
+
+    def digits(self):
+        """Return (atlas, advance, height), the digits 0-9 pre-rendered side
+        by side, advance wide each, in the current font and number color"""
+        font = self.font()
+        ratio = self.devicePixelRatioF()
+        key = (font.key(), self.num_color.rgba(), ratio)
+        if key != self._atlas_key:
+            metrics = QtGui.QFontMetrics(font)
+            advance = max(metrics.width(str(x)) for x in range(10))
+            height = metrics.height()
+            atlas = QtGui.QPixmap(
+                int(advance * 10 * ratio), int(height * ratio))
+            atlas.setDevicePixelRatio(ratio)
+            atlas.fill(QtCore.Qt.transparent)
+            painter = QtGui.QPainter(atlas)
+            painter.setFont(font)
+            painter.setPen(self.num_color)
+            for x in range(10):
+                painter.drawText(
+                    x * advance, 0, advance, height, QtCore.Qt.AlignRight,
+                    str(x))
+            painter.end()
+            self._atlas = (atlas, advance, height)
+            self._atlas_key = key
+        return self._atlas
+
+
+class DocumentCache(QtCore.QObject):
+    """Highlighted documents of recently shown snippets, least recently used
+    first, keyed by label and content hash.
+
+    The cache owns its documents. Their memory use is estimated from their
+    length and kept under budget bytes. A document dropped while the
+    editor still shows it is retired and deleted once the editor moves on.
+    """
+    bytes_per_char = 24  # text, layouts and formats, a rough estimate
+
+    def __init__(self, budget, parent=None):
+        super(DocumentCache, self).__init__(parent)
+        self.budget = budget
+        self._documents = collections.OrderedDict()  # key -> (doc, cost)
+        self._size = 0
+        self._retired = []
+
+    def key(self, label, text):
+        return (label, hash(text))
+
+    def get(self, label, text):
+        key = self.key(label, text)
+        entry = self._documents.get(key)
+        if entry is None:
+            return None
+        if entry[0].isModified():  # edited since it was cached
+            self._remove(key)
+            return None
+        self._documents.move_to_end(key)
+        return entry[0]
+
+    def add(self, label, text, document, keep=None):
+        """Cache a document, evicting the least recently used ones other
+        than keep that do not fit the budget"""
+        document.setParent(self)
+        cost = max(1, document.characterCount()) * self.bytes_per_char
+        key = self.key(label, text)
+        if key in self._documents:
+            self._remove(key)
+        self._documents[key] = (document, cost)
+        self._size += cost
+        for key in list(self._documents):
+            if self._size <= self.budget:
+                break
+            if self._documents[key][0] is not keep:
+                self._remove(key)
+
+    def discard(self, label):
+        """Drop every document of a snippet, e.g. after it was saved or
+        renamed"""
+        for key in [x for x in self._documents if x[0] == label]:
+            self._remove(key)
+
+    def clear(self):
+        for key in list(self._documents):
+            self._remove(key)
+
+    def collect(self, current):
+        """Delete the retired documents other than current"""
+        keep = []
+        for document in self._retired:
+            if document is current:
+                keep.append(document)
+            else:
+                document.highlighter.cancel()
+                document.deleteLater()
+        self._retired = keep
+
+    def _remove(self, key):
+        document, cost = self._documents.pop(key)
+        self._size -= cost
+        self._retired.append(document)
 
 
 class VexEditor(QtWidgets.QPlainTextEdit):
+    defer_lines = 1000  # texts this long are highlighted in idle time, 0=off
+    defer_margin = 50  # blocks beyond the viewport highlighted right away
+
     def __init__(self, parent=None):
         super(VexEditor, self).__init__(parent)
+        self.documents = DocumentCache(32 * 1024 * 1024, self)
         self.line_num_area = LineNumberArea(self)
+        self._line_num_width = None
+        self._current_block = -1  # block of the highlighted line number
+        self._line_num_state = None  # what the line numbers were painted for
         self.connect(self, QtCore.SIGNAL('blockCountChanged(int)'),
-                     self._update_line_num_width)
+                     self._block_count_changed)
         self.connect(self, QtCore.SIGNAL('updateRequest(QRect,int)'),
                      self._update_line_num_area)
+        self.cursorPositionChanged.connect(self._update_current_line)
         self._update_line_num_width(0)
         self._init_ui()
 
     def _init_ui(self):
         self.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
         self.installEventFilter(self)
-        self.highlighter = vex_highlighter.VexHighlighter(
-            self.document())
-        root = os.path.abspath(os.path.join(__file__, '..', '..', '..', '..'))
-        fonts = os.path.join(root, 'resources', 'fonts')
-        QtGui.QFontDatabase.addApplicationFont(
-            os.path.join(fonts, 'SourceCodePro-Regular.ttf'))
+        # the scratch document holds text that is not a cached snippet
+        self.scratch = self._new_document()
+        self.setDocument(self.scratch)
+        self.highlighter = self.scratch.highlighter
+        self.verticalScrollBar().valueChanged.connect(self._highlight_visible)
+        register_fonts()
 
         font = QtGui.QFont('Source Code Pro')
         self.setFont(font)
@@ -69,16 +200,9 @@ class VexEditor(QtWidgets.QPlainTextEdit):
             if key == QtCore.Qt.Key_Tab:
                 cursor = self.textCursor()
                 if cursor.hasSelection():
-                    lines = self._lines_from_sel(cursor)
-                    cursor.beginEditBlock()
-                    for line in lines:
-                        doc = self.document()
-                        get_block = doc.findBlockByLineNumber(line)
-                        cursor = QtGui.QTextCursor(get_block)
-                        self.setTextCursor(cursor)
-                        self.insertPlainText('    ')
-                    cursor.endEditBlock()
-                    self._select_lines(lines)
+                    first, last = self._blocks_from_sel(cursor)
+                    self.indent_blocks(first, last)
+                    self._select_blocks(first, last)
                 else:
                     self.insertPlainText('    ')
                 return True
@@ -87,19 +211,12 @@ class VexEditor(QtWidgets.QPlainTextEdit):
             if key == QtCore.Qt.Key_Backtab:
                 cursor = self.textCursor()
                 if cursor.hasSelection():
-                    lines = self._lines_from_sel(cursor)
-                    cursor.beginEditBlock()
-                    for line in lines:
-                        doc = self.document()
-                        get_block = doc.findBlockByLineNumber(line)
-                        cursor = QtGui.QTextCursor(get_block)
-                        self._unindent_line(cursor)
-                    cursor.endEditBlock()
-                    self._select_lines(lines)
-                    return True
+                    first, last = self._blocks_from_sel(cursor)
+                    self.unindent_blocks(first, last)
+                    self._select_blocks(first, last)
                 else:
-                    self._unindent_line(cursor)
-                    return True
+                    self.unindent_blocks(cursor.block(), cursor.block())
+                return True
 
             # enter indent level
             if key == QtCore.Qt.Key_Return:
@@ -124,6 +241,70 @@ class VexEditor(QtWidgets.QPlainTextEdit):
 
         return QtWidgets.QWidget.eventFilter(self, widget, event)
 
+    def _new_document(self):
+        document = QtGui.QTextDocument(self.documents)
+        document.setDocumentLayout(
+            QtWidgets.QPlainTextDocumentLayout(document))
+        with profiler.span('highlighter'):
+            document.highlighter = vex_highlighter.VexHighlighter(document)
+        return document
+
+    def _show_document(self, document):
+        if document is not self.document():
+            # only the document in view highlights in idle time, cached
+            # ones carry on from their pending blocks when shown again
+            self.highlighter.pause()
+            font = self.font()
+            self.setDocument(document)
+            document.setDefaultFont(font)
+            self.highlighter = document.highlighter
+            if self.highlighter.is_deferring():
+                self._highlight_visible(None)
+                self.highlighter.resume()
+            self._current_block = self.textCursor().blockNumber()
+            self.line_num_area.update()
+        self.documents.collect(document)
+
+    def show_snippet(self, label, text):
+        """Show a snippet's text, reusing its highlighted document when the
+        same text was shown recently"""
+        document = self.documents.get(label, text)
+        if document is None:
+            document = self._new_document()
+            self._defer_highlighting(document.highlighter, text)
+            with profiler.span('highlight', label=label):
+                document.setPlainText(text)
+            profiler.count('rehighlights')
+            document.setModified(False)
+            self.documents.add(label, text, document, keep=self.document())
+        self._show_document(document)
+
+    def setPlainText(self, text):
+        """Set the text of the scratch document, large texts only get the
+        blocks in view highlighted before this returns"""
+        if self.document() is not self.scratch:
+            self._show_document(self.scratch)
+        self._defer_highlighting(self.highlighter, text)
+        with profiler.span('highlight'):
+            super(VexEditor, self).setPlainText(text)
+        profiler.count('rehighlights')
+
+    def _defer_highlighting(self, highlighter, text):
+        if self.defer_lines and text.count('\n') >= self.defer_lines:
+            highlighter.defer(self._visible_blocks() + self.defer_margin)
+        else:
+            highlighter.cancel()
+
+    def _visible_blocks(self):
+        line_height = max(1, self.fontMetrics().height())
+        return self.viewport().height() // line_height + 1
+
+    def _highlight_visible(self, _):
+        if self.highlighter.is_deferring():
+            first = self.firstVisibleBlock().blockNumber()
+            self.highlighter.highlight_to(
+                first + self._visible_blocks() + self.defer_margin)
+
     def disable_editor(self):
         self.setReadOnly(True)
         self.line_num_area.disable()
@@ -134,44 +315,50 @@ class VexEditor(QtWidgets.QPlainTextEdit):
         self.line_num_area.enable()
         self.setStyleSheet("QPlainTextEdit {background-color:#131313;}")
 
-    def _unindent_line(self, cursor):
-        """Unindent current line at cursor"""
-        pos = cursor.position()
-        cursor.clearSelection()
-        cursor.movePosition(QtGui.QTextCursor.EndOfLine,
-                            QtGui.QTextCursor.MoveAnchor)
-        cursor.movePosition(QtGui.QTextCursor.StartOfLine,
-                            QtGui.QTextCursor.KeepAnchor)
-
-        line_txt = str(cursor.selectedText()).replace('\u2029', '\n')
-        leading_whitespace = len(line_txt) - len(line_txt.lstrip())
-        cursor.insertText(line_txt[min(3, leading_whitespace):])
-        cursor.setPosition(pos - min(3, leading_whitespace))
-
-    def _select_lines(self, lines):
-        """Selects full lines, expects lines to be a generator"""
-        doc = self.document()
-        start_block = doc.findBlockByLineNumber(lines[0])
-        cursor = QtGui.QTextCursor(start_block)
-        cursor.movePosition(QtGui.QTextCursor.EndOfLine,
-                            QtGui.QTextCursor.KeepAnchor)
-        for x in lines[1:]:
-            cursor.movePosition(QtGui.QTextCursor.NextBlock,
-                                QtGui.QTextCursor.KeepAnchor)
-            cursor.movePosition(QtGui.QTextCursor.EndOfBlock,
-                                QtGui.QTextCursor.KeepAnchor)
+    def indent_blocks(self, first, last):
+        """Indent the blocks from first to last by four spaces as one edit,
+        highlighted once and undone in one step"""
+        self._edit_blocks(first, last, lambda text: 4)
+
+    def unindent_blocks(self, first, last):
+        """Remove up to three leading whitespace characters from the blocks
+        from first to last as one edit"""
+        def remove(text):
+            return -min(3, len(text) - len(text.lstrip()))
+        self._edit_blocks(first, last, remove)
+
+    def _edit_blocks(self, first, last, change):
+        """Apply change(text), the number of spaces to add at the start of a
+        block or minus the number of characters to remove, to each block"""
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.beginEditBlock()
+        block = first
+        end = last.blockNumber()
+        while block.isValid() and block.blockNumber() <= end:
+            count = change(block.text())
+            if count > 0:
+                cursor.setPosition(block.position())
+                cursor.insertText(' ' * count)
+            elif count < 0:
+                cursor.setPosition(block.position())
+                cursor.setPosition(block.position() - count,
+                                   QtGui.QTextCursor.KeepAnchor)
+                cursor.removeSelectedText()
+            block = block.next()
+        cursor.endEditBlock()
+
+    def _select_blocks(self, first, last):
+        """Select from the start of first to the end of last"""
+        cursor = QtGui.QTextCursor(first)
+        cursor.setPosition(last.position() + last.length() - 1,
+                           QtGui.QTextCursor.KeepAnchor)
         self.setTextCursor(cursor)
 
-    def _lines_from_sel(self, cursor):
-        """Return selected lines as a generator object"""
-        sel_start = cursor.selectionStart()
-        sel_end = cursor.selectionEnd()
-        tmp = self.textCursor()
-        tmp.setPosition(sel_start)
-        start_line = tmp.blockNumber()
-        tmp.setPosition(sel_end)
-        end_line = tmp.blockNumber()
-        return range(start_line, end_line + 1)
+    def _blocks_from_sel(self, cursor):
+        """Return the first and last block touched by the selection"""
+        document = self.document()
+        return (document.findBlock(cursor.selectionStart()),
+                document.findBlock(cursor.selectionEnd()))
 
     def _line_num_area_width(self):
         digits = 1
@@ -184,18 +371,50 @@ class VexEditor(QtWidgets.QPlainTextEdit):
         return space
 
     def _update_line_num_width(self, _):
-        self.setViewportMargins(self._line_num_area_width(), 0, 0, 0)
+        width = self._line_num_area_width()
+        if width != self._line_num_width:
+            self._line_num_width = width
+            self.setViewportMargins(width, 0, 0, 0)
 
-    def _update_line_num_area(self, rect, dy):
+    def _block_count_changed(self, count):
+        self._update_line_num_width(count)
+        self.line_num_area.update()  # numbers below the change moved
+
+    def _line_num_area_state(self):
+        return (self.firstVisibleBlock().blockNumber(),
+                self.contentOffset().y(), self.blockCount(),
+                self.fontMetrics().height(), self.viewport().height())
 
+    def _update_line_num_area(self, rect, dy):
+        """Follow scrolling, and full repaints of the text that move the
+        line numbers. Cursor blinks and edits within a line leave the
+        numbers as they are."""
+        state = self._line_num_area_state()
         if dy:
             self.line_num_area.scroll(0, dy)
-        else:
-            self.line_num_area.update(
-                0, rect.y(), self.line_num_area.width(), rect.height())
-
-        if rect.contains(self.viewport().rect()):
+        elif (state != self._line_num_state and
+                rect.contains(self.viewport().rect())):
             self._update_line_num_width(0)
+            self.line_num_area.update()
+        self._line_num_state = state
+
+    def _update_current_line(self):
+        """Repaint only the numbers of the lines the cursor left and
+        entered"""
+        number = self.textCursor().blockNumber()
+        if number == self._current_block:
+            return
+        document = self.document()
+        for x in (self._current_block, number):
+            block = document.findBlockByNumber(x)
+            if block.isValid():
+                top = self.blockBoundingGeometry(block).translated(
+                    self.contentOffset()).top()
+                height = self.blockBoundingRect(block).height()
+                self.line_num_area.update(
+                    0, int(top), self.line_num_area.width(),
+                    int(height) + 1)
+        self._current_block = number
 
     def resizeEvent(self, event):
         super().resizeEvent(event)
@@ -206,31 +425,44 @@ class VexEditor(QtWidgets.QPlainTextEdit):
                 cr.left(), cr.top(), self._line_num_area_width(), cr.height()))
 
     def line_num_area_paint(self, event):
+        """Paint the line numbers in the dirty rect from the digit atlas.
+
+        Lines never wrap, so every block is one line of the same height and
+        only the rows inside the rect are visited.
+        """
         my_painter = QtGui.QPainter(self.line_num_area)
+        rect = event.rect()
+        my_painter.fillRect(rect, self.line_num_area.bg_color)
 
-        my_painter.fillRect(event.rect(), self.line_num_area.bg_color)
+        atlas, advance, height = self.line_num_area.digits()
+        ratio = atlas.devicePixelRatio()
+        width = self.line_num_area.width()
+        current = self._current_block
+        line_color = self.line_num_area.line_color
 
         block = self.firstVisibleBlock()
-        blockNumber = block.blockNumber()
+        if not block.isValid():
+            return
         top = self.blockBoundingGeometry(block).translated(
             self.contentOffset()).top()
-        bottom = top + self.blockBoundingRect(block).height()
-
-        height = self.fontMetrics().height()
-        while block.isValid() and (top <= event.rect().bottom()):
-            if block.isVisible() and (bottom >= event.rect().top()):
-                number = str(blockNumber + 1)
-                if block == self.textCursor().block():
-                    line_rect = QtCore.QRect(
-                        0, top, self.line_num_area.width(), height)
-                    my_painter.fillRect(
-                        line_rect, self.line_num_area.line_color)
-                my_painter.setPen(self.line_num_area.num_color)
-                my_painter.drawText(
-                    0, top, self.line_num_area.width(),
-                    height, QtCore.Qt.AlignRight, number)
-
-            block = block.next()
-            top = bottom
-            bottom = top + self.blockBoundingRect(block).height()
+        line_height = self.blockBoundingRect(block).height() or height
+        skip = max(0, int((rect.top() - top) // line_height))
+        blockNumber = block.blockNumber() + skip
+        top += skip * line_height
+        count = self.blockCount()
+
+        while blockNumber < count and top <= rect.bottom():
+            if blockNumber == current:
+                my_painter.fillRect(
+                    QtCore.QRectF(0, top, width, height), line_color)
+            number = str(blockNumber + 1)
+            x = width - advance * len(number)
+            for digit in number:
+                source = QtCore.QRectF(
+                    int(digit) * advance * ratio, 0,
+                    advance * ratio, height * ratio)
+                my_painter.drawPixmap(
+                    QtCore.QRectF(x, top, advance, height), atlas, source)
+                x += advance
+            top += line_height
             blockNumber += 1
@@ -1,8 +1,130 @@
 import os
 
+import re
+
+import json
+
+import bisect
+
+import logging
+
 from zipfile import ZipFile
 
-from PySide2 import QtGui, QtCore
+from PySide2 import QtCore, QtGui
+
+from ..profiler import profiler
+
+logger = logging.getLogger('vex_snippet_library.main_panel.vex_highlighter')
+
+VEX_DIR = os.path.abspath(os.path.join(
+    __file__, '..', '..', '..', '..', 'resources', 'vex_syntax'))
+SYNTAX_FILES = ('data_types', 'functions', 'keywords', 'macros', 'comments')
+CACHE_FILE = 'syntax_cache.json'
+
+# block states, carried from one line to the next
+NORMAL = 0
+IN_COMMENT = 1
+IN_STRING_DOUBLE = 2
+IN_STRING_SINGLE = 3
+PENDING = -2  # not highlighted yet, see VexHighlighter.defer
+
+_token = re.compile(r"""
+    (?P<comment>//.*)
+  | (?P<comment_start>/\*)
+  | (?P<string>(?P<quote>["'])(?:(?!(?P=quote))[^\\]|\\.)*
+        (?P<string_end>(?P=quote)|\\)?)
+  | (?P<macros>\#(?:[^/]|/(?![/*]))*)
+  | (?P<attributes>(?<!\w)[A-Za-z0-9]?@\w+)
+  | (?P<word>[A-Za-z_]\w*)
+  | (?P<number>[0-9]\w*)
+""", re.VERBOSE)
+
+# rest of a string continued from the previous line
+_string_rest = {
+    '"': re.compile(r'(?:[^"\\]|\\.)*(?P<string_end>"|\\)?'),
+    "'": re.compile(r"(?:[^'\\]|\\.)*(?P<string_end>'|\\)?")
+}
+
+_string_states = {
+    '"': (IN_STRING_DOUBLE, 'string_double'),
+    "'": (IN_STRING_SINGLE, 'string_single')
+}
+
+_call = re.compile(r'\s*(?:\(|$)')
+
+
+class VexLexer(object):
+    """Splits a line of VEX into non-overlapping (start, length, kind) spans.
+
+    Every character is scanned once. Identifiers are looked up in hashed
+    word sets, keywords win over functions, which win over data types, and
+    functions are only colored where they are called. Text between spans
+    is default text. Block comments and strings continued with a trailing
+    backslash carry over to the next line through the returned state.
+    """
+    def __init__(self, keywords, functions, data_types):
+        self.keywords = frozenset(keywords)
+        self.functions = frozenset(functions)
+        self.data_types = frozenset(data_types)
+
+    def tokens(self, text, state=NORMAL):
+        """Return (spans, state) for a line, given the previous line's state"""
+        spans = []
+        length = len(text)
+        pos = 0
+        if state == IN_COMMENT:
+            pos = self._comment_end(text, 0)
+            if pos < 0:
+                return [(0, length, 'comment')], IN_COMMENT
+            spans.append((0, pos, 'comment'))
+        elif state in (IN_STRING_DOUBLE, IN_STRING_SINGLE):
+            quote = '"' if state == IN_STRING_DOUBLE else "'"
+            match = _string_rest[quote].match(text)
+            pos = match.end()
+            spans.append((0, pos, _string_states[quote][1]))
+            if match.group('string_end') == '\\':
+                return spans, state
+
+        search = _token.search
+        keywords = self.keywords
+        functions = self.functions
+        data_types = self.data_types
+        while pos < length:
+            match = search(text, pos)
+            if match is None:
+                break
+            kind = match.lastgroup
+            start, pos = match.span()
+            if kind == 'word':
+                word = match.group()
+                if word in keywords:
+                    kind = 'keywords'
+                elif word in functions and _call.match(text, pos):
+                    kind = 'functions'
+                elif word in data_types:
+                    kind = 'data_types'
+                else:
+                    continue
+            elif kind == 'number':
+                continue
+            elif kind == 'comment_start':
+                kind = 'comment'
+                pos = self._comment_end(text, pos)
+                if pos < 0:
+                    spans.append((start, length - start, kind))
+                    return spans, IN_COMMENT
+            elif kind == 'string':
+                new_state, kind = _string_states[match.group('quote')]
+                if match.group('string_end') == '\\':
+                    spans.append((start, pos - start, kind))
+                    return spans, new_state
+            spans.append((start, pos - start, kind))
+        return spans, NORMAL
+
+    def _comment_end(self, text, pos):
+        """Position after the */ closing a block comment, or -1"""
+        end = text.find('*/', pos)
+        return end + 2 if end >= 0 else -1
 
 
 class VexSyntaxUtilities():
@@ -17,25 +139,12 @@ class VexSyntaxUtilities():
         self.vex_comments = ''
 
     def load_vex_syntax(self):
-        data_types_file = os.path.join(self.vex_dir, 'vex_data_types.txt')
-        with open(data_types_file, 'r') as t:
-            self.vex_data_types = '|'.join(t.read().splitlines())
-
-        functions_file = os.path.join(self.vex_dir, 'vex_functions.txt')
-        with open(functions_file, 'r') as t:
-            self.vex_functions = '|'.join(t.read().splitlines())
-
-        keywords_file = os.path.join(self.vex_dir, 'vex_keywords.txt')
-        with open(keywords_file, 'r') as t:
-            self.vex_keywords = '|'.join(t.read().splitlines())
-
-        macros_file = os.path.join(self.vex_dir, 'vex_macros.txt')
-        with open(macros_file, 'r') as t:
-            self.vex_macros = '|'.join(t.read().splitlines())
-
-        comments_file = os.path.join(self.vex_dir, 'vex_comments.txt')
-        with open(comments_file, 'r') as t:
-            self.vex_comments = '|'.join(t.read().splitlines())
+        tables = syntax_tables(self.vex_dir)
+        self.vex_data_types = '|'.join(tables['data_types'])
+        self.vex_functions = '|'.join(tables['functions'])
+        self.vex_keywords = '|'.join(tables['keywords'])
+        self.vex_macros = '|'.join(tables['macros'])
+        self.vex_comments = '|'.join(tables['comments'])
 
     def verify_vex_syntax(self):
         if not os.path.isdir(self.vex_dir):
@@ -101,84 +210,198 @@ class VexColors():
             QtGui.QColor(102, 204, 102)))
 
 
-class VexHighlighter(QtGui.QSyntaxHighlighter):
-    def __init__(self, *args, **kwargs):
-        super(VexHighlighter, self).__init__(*args, **kwargs)
-        self.utils = VexSyntaxUtilities()
-        self.utils.load_vex_syntax()
-        self.colors = VexColors().colors
-        self.patterns = {
-            'data_types': r'\b({})\b(?=\s|$)'.format(self.utils.vex_data_types),
-            'functions': r'\b({})(?=\s|[(]|$)'.format(self.utils.vex_functions),
-            'keywords': r'\b({})(?=\s|[(]|$)'.format(self.utils.vex_keywords),
-            'attributes': r'((?<!\w)[A-Za-z0-9]?)\@\w+',
-            'string_double': r'"[^"\\]*(\\.[^"\\]*)*"',
-            'string_single': r"'[^'\\]*(\\.[^'\\]*)*'",
-            'macros': r'#[^\n]*',
-            'comment': r'\/\/[^\n]*'
-            }
-
-    def highlightBlock(self, text):
-        self.setFormat(0, len(text), self.colors['default'])
-        for pattern, exp in self.patterns.items():
-            expression = QtCore.QRegularExpression(self.patterns[pattern])
-            index = expression.globalMatch(text, 0)
-            while index.hasNext():
-                match = index.next()
-                start = match.capturedStart()
-                end = match.capturedLength()
-                self.setFormat(start, end, self.colors[pattern])
-
-        # multi-line comments
-        self.setCurrentBlockState(0)
-        comment_start = QtCore.QRegExp(r'(\/\*)')
-        comment_end = QtCore.QRegExp(r'(\*\/)')
-        in_multiline = self.match_multiline(
-            text, comment_start, comment_end, 1, self.colors['comment'])
-
-    def match_multiline(self, text, start_pattern, end_pattern, in_state, style):
-            """Do highlighting of multi-line strings. ``delimiter`` should be a
-            ``QRegExp`` for triple-single-quotes or triple-double-quotes, and
-            ``in_state`` should be a unique integer to represent the corresponding
-            state changes when inside those strings. Returns True if we're still
-            inside a multi-line string when this function is finished.
-            """
-            # If inside triple-single quotes, start at 0
-            if self.previousBlockState() == in_state:
-                start = 0
-                add = 0
-            # Otherwise, look for the delimiter on this line
-            else:
-                start = start_pattern.indexIn(text)
-                # Move past this match
-                add = start_pattern.matchedLength()
-
-            # As long as there's a delimiter match on this line...
-            while start >= 0:
-                # Look for the ending delimiter
-                end = end_pattern.indexIn(text, start + add)
-                # Ending delimiter on this line?
-                if end >= add:
-                    length = end - start + add + end_pattern.matchedLength()
-                    self.setCurrentBlockState(0)
-                # No; multi-line string
-                else:
-                    self.setCurrentBlockState(in_state)
-                    length = len(text) - start + add
-                # Apply formatting
-                self.setFormat(start, length, style)
-                # Look for the next match
-                start = start_pattern.indexIn(text, start + length)
-
-            # Return True if still inside a multi-line string, False otherwise
-            if self.currentBlockState() == in_state:
-                return True
-            else:
-                return False
-
-
+# Syntax tables, lexers and formats are shared by every highlighter in the
+# session. The tables are keyed by the syntax file mtimes and cached on
+# disk, so a fresh import of the module does not parse the files again.
+_syntax = {}  # vex_dir -> (mtimes, tables, lexer)
+_formats = None
+
+
+def syntax_mtimes(vex_dir):
+    mtimes = []
+    for name in SYNTAX_FILES:
+        path = os.path.join(vex_dir, 'vex_{}.txt'.format(name))
+        try:
+            mtimes.append(os.path.getmtime(path))
+        except OSError:
+            mtimes.append(None)
+    return mtimes
+
+
+def read_syntax_files(vex_dir):
+    tables = {}
+    for name in SYNTAX_FILES:
+        path = os.path.join(vex_dir, 'vex_{}.txt'.format(name))
+        try:
+            with open(path, 'r') as t:
+                tables[name] = [x for x in t.read().splitlines() if x]
+        except OSError as e:
+            logger.warning('Could not read {}: {}'.format(path, e))
+            tables[name] = []
+    return tables
+
+
+def read_syntax_cache(vex_dir, mtimes):
+    """Return the cached tables if they were built from the current files"""
+    try:
+        with open(os.path.join(vex_dir, CACHE_FILE), 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('mtimes') != mtimes:
+        return None
+    return cache.get('tables')
+
+
+def write_syntax_cache(vex_dir, mtimes, tables):
+    path = os.path.join(vex_dir, CACHE_FILE)
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'mtimes': mtimes, 'tables': tables}, f,
+                      separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        logger.debug('Could not write {}: {}'.format(path, e))
+
+
+def _load_syntax(vex_dir):
+    mtimes = syntax_mtimes(vex_dir)
+    entry = _syntax.get(vex_dir)
+    if entry is None or entry[0] != mtimes:
+        tables = read_syntax_cache(vex_dir, mtimes)
+        if tables is None:
+            tables = read_syntax_files(vex_dir)
+            write_syntax_cache(vex_dir, mtimes, tables)
+        lexer = VexLexer(
+            tables['keywords'], tables['functions'], tables['data_types'])
+        entry = _syntax[vex_dir] = (mtimes, tables, lexer)
+    return entry
+
+
+def syntax_tables(vex_dir=VEX_DIR):
+    """Return {name: words} for each vex_<name>.txt syntax file"""
+    return _load_syntax(vex_dir)[1]
+
+
+def shared_lexer(vex_dir=VEX_DIR):
+    return _load_syntax(vex_dir)[2]
+
+
+def formats():
+    """Return the text formats shared by every highlighter"""
+    global _formats
+    if _formats is None:
+        _formats = VexColors().colors
+    return _formats
 
 
+class VexHighlighter(QtGui.QSyntaxHighlighter):
+    """Highlights VEX with the shared lexer.
 
+    Highlighting can be deferred for large texts: only the blocks up to a
+    limit are highlighted when the text is set, the rest follows in idle
+    time chunks of chunk_size blocks, in document order so block states
+    stay correct. Skipped blocks are marked PENDING, so highlighting one
+    block carries on through the following ones up to the limit.
+    """
+    chunk_size = 200
 
+    def __init__(self, *args, **kwargs):
+        super(VexHighlighter, self).__init__(*args, **kwargs)
+        self.colors = formats()
+        self.lexer = shared_lexer()
+        self._limit = None  # last block to highlight while deferring
+        self._done = -1  # last block highlighted while deferring
+        self._timer = QtCore.QTimer(self)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._highlight_chunk)
+
+    def defer(self, first_blocks):
+        """Highlight only the first blocks of the next text set on the
+        document, and the rest in idle time"""
+        self._limit = first_blocks - 1
+        self._done = -1
+        self._timer.start()
+
+    def cancel(self):
+        """Stop deferred highlighting, every block is highlighted as it
+        changes again"""
+        self._timer.stop()
+        self._limit = None
+
+    def pause(self):
+        """Stop highlighting in idle time, the blocks still pending are
+        highlighted by highlight_to or after resume"""
+        self._timer.stop()
+
+    def resume(self):
+        if self._limit is not None:
+            self._timer.start()
+
+    def is_deferring(self):
+        return self._limit is not None
+
+    def highlight_to(self, block_number):
+        """Highlight every block up to block_number now, e.g. when it is
+        scrolled into view"""
+        if self._limit is None:
+            return
+        document = self.document()
+        last = document.blockCount() - 1
+        self._limit = min(max(self._limit, block_number), last)
+        while self._done < self._limit:
+            # continues through the pending blocks up to the limit
+            self.rehighlightBlock(document.findBlockByNumber(self._done + 1))
+        if self._done >= last:
+            self.cancel()
+
+    def _highlight_chunk(self):
+        if self._limit is None or self.document() is None:
+            self.cancel()
+            return
+        self.highlight_to(self._done + self.chunk_size)
 
+    def highlightBlock(self, text):
+        profiler.count('highlighted_blocks')
+        if self._limit is not None:
+            number = self.currentBlock().blockNumber()
+            if number > self._limit:
+                self.setCurrentBlockState(PENDING)
+                return
+            if number > self._done:
+                self._done = number
+
+        spans, state = self.lexer.tokens(text, self.previousBlockState())
+        length = len(text)
+        if not text.isascii():
+            spans, length = utf16_spans(text, spans)
+
+        colors = self.colors
+        default = colors['default']
+        pos = 0
+        for start, span_length, kind in spans:
+            if start > pos:
+                self.setFormat(pos, start - pos, default)
+            self.setFormat(start, span_length, colors[kind])
+            pos = start + span_length
+        if pos < length:
+            self.setFormat(pos, length - pos, default)
+        self.setCurrentBlockState(state)
+
+
+def utf16_spans(text, spans):
+    """Convert spans over python characters to the UTF-16 positions Qt
+    uses, characters outside the BMP take two positions in Qt"""
+    wide = [i for i, x in enumerate(text) if ord(x) > 0xFFFF]
+    if not wide:
+        return spans, len(text)
+
+    def convert(pos):
+        return pos + bisect.bisect_left(wide, pos)
+
+    converted = []
+    for start, length, kind in spans:
+        end = convert(start + length)
+        start = convert(start)
+        converted.append((start, end - start, kind))
+    return converted, convert(len(text))
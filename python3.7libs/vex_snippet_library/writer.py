@@ -0,0 +1,97 @@
+import logging
+
+import sqlite3
+
+import threading
+
+import collections
+
+from PySide2 import QtCore
+
+from .snippet import Snippet
+
+from .tasks import TaskSignals
+
+from .profiler import profiler
+
+logger = logging.getLogger('vex_snippet_library.main_panel.writer')
+
+
+class WriterSignals(TaskSignals):
+    failed = QtCore.Signal(object, str)
+
+
+class WriterTask(QtCore.QRunnable):
+    """Writes queued snippets to a store on a pool thread.
+
+    Snippets are queued by label, queueing a label again before it was
+    written replaces the queued copy, so rapid saves are written once.
+    Everything queued while a batch is written goes out as the next
+    batch.
+    """
+    def __init__(self, store, signals):
+        super(WriterTask, self).__init__()
+        self.store = store
+        self.signals = signals
+        self.pending = collections.OrderedDict()  # label -> snippet
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.running = False
+
+    def queue(self, snippet):
+        """Queue a snippet, return True if the task has to be started"""
+        with self.lock:
+            self.pending.pop(snippet.label, None)
+            self.pending[snippet.label] = snippet
+            self.idle.clear()
+            if self.running:
+                return False
+            self.running = True
+            return True
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.running = False
+                    self.idle.set()
+                    return
+                batch = list(self.pending.values())
+                self.pending.clear()
+
+            labels = [x.label for x in batch]
+            try:
+                with profiler.span('save', snippets=len(batch)):
+                    self.store.write_many(batch)
+            except (OSError, ValueError, sqlite3.Error) as e:
+                logger.error('Could not write {}: {}'.format(labels, e))
+                self.signals.send('failed', labels, str(e))
+
+
+class SnippetWriter(QtCore.QObject):
+    """Write-behind queue for saving snippets off the GUI thread.
+
+    write copies the snippet and returns at once. flush blocks until the
+    queue is on disk, call it before the library goes away and before
+    renaming or deleting files the queue may still write.
+    """
+    failed = QtCore.Signal(object, str)
+
+    def __init__(self, store, parent=None):
+        super(SnippetWriter, self).__init__(parent)
+        self.store = store
+        self._signals = WriterSignals()
+        self._signals.forward(self, 'failed')
+        self._task = WriterTask(self.store, self._signals)
+        self._task.setAutoDelete(False)
+
+    def write(self, snippet):
+        copy = Snippet(snippet.to_dict())
+        copy.source = snippet.source
+        if self._task.queue(copy):
+            QtCore.QThreadPool.globalInstance().start(self._task)
+
+    def flush(self, timeout=None):
+        """Wait for queued writes, return False if timeout ran out first"""
+        return self._task.idle.wait(timeout)
@@ -0,0 +1,81 @@
+"""Tests of the directory store's file names.
+
+Run with python -m unittest discover tests, from the repository root.
+"""
+import os
+
+import sys
+
+import json
+
+import shutil
+
+import tempfile
+
+import unittest
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'python3.7libs'))
+
+from vex_snippet_library import storage  # noqa: E402
+from vex_snippet_library.snippet import Snippet  # noqa: E402
+
+
+class DirectoryStoreNamesTest(unittest.TestCase):
+    """A file named a.json may store any label, e.g. after a rename made
+    outside the panel. Writes and renames must never replace it."""
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = storage.DirectoryStore(os.path.join(self.root, 'json'))
+        # a.json stores the snippet b
+        self.write_file('a', {'label': 'b', 'context': 'Points',
+                              'data': 'int b;\n'})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_file(self, name, obj):
+        with open(self.store.path(name), 'w') as f:
+            json.dump(obj, f)
+
+    def stored(self):
+        """Return {file name: stored label}"""
+        return dict((self.store.label(x), self.store._parse(x).label)
+                    for x in self.store.scan())
+
+    def test_read_keeps_stored_label(self):
+        self.assertEqual(self.stored(), {'a': 'b'})
+        snippet = self.store.read(self.store.scan()[0])
+        self.assertEqual(snippet.label, 'b')
+        self.assertEqual(snippet.source, self.store.path('a'))
+        self.assertEqual(snippet.data, 'int b;\n')
+
+    def test_new_snippet_does_not_replace_file(self):
+        snippet = Snippet({'label': 'a', 'context': 'Detail', 'data': ''})
+        snippet.source = self.store.source(snippet.label)
+        self.assertEqual(snippet.source, self.store.path('a_1'))
+        self.store.write(snippet)
+        self.assertEqual(self.stored(), {'a': 'b', 'a_1': 'a'})
+
+    def test_new_snippet_skips_taken_sources(self):
+        taken = {self.store.path('c')}  # queued, not written yet
+        self.assertEqual(self.store.source('c', taken),
+                         self.store.path('c_1'))
+
+    def test_rename_does_not_replace_file(self):
+        self.write_file('c', {'label': 'c', 'context': 'Detail',
+                              'data': ''})
+        snippet = self.store._parse(self.store.path('c'))
+        source = self.store.rename(snippet, 'a')
+        self.assertEqual(source, self.store.path('a_1'))
+        self.assertEqual(self.stored(), {'a': 'b', 'a_1': 'c'})
+
+    def test_rename_to_own_file_name(self):
+        snippet = self.store._parse(self.store.path('a'))
+        source = self.store.rename(snippet, 'a')
+        self.assertEqual(source, self.store.path('a'))
+        self.assertEqual(self.stored(), {'a': 'b'})
+
+
+if __name__ == '__main__':
+    unittest.main()